@@ -0,0 +1,346 @@
+# Vectorized population engine: every city's 32 population groups are kept
+# in one (n_cities, 32) integer array and a week is simulated with whole-array
+# operations instead of a python loop over cities.
+
+import numpy as np
+
+from constants import *
+from engine import Population, POPULATION_LAYOUT, CityStream, GOLDEN_GAMMA, CAPPED_SPLIT_DRAWS, seed_root
+
+
+N_POP_CATS = Population.N_POP_CATS
+AGGREGATES = POPULATION_LAYOUT.AGGREGATES
+
+# column k selects the groups of aggregate AGGREGATES[k]
+AGGREGATE_MATRIX = np.array([POPULATION_LAYOUT.masks[name] for name in AGGREGATES], dtype=np.int64).T
+AGGREGATE_COLUMN = {name: k for k, name in enumerate(AGGREGATES)}
+
+# weekly shift as a 0/1 transition matrix, row src has its one at shift_target[src];
+# float so the product goes through BLAS, counts stay exact far beyond any population
+SHIFT_MATRIX = np.zeros((N_POP_CATS, N_POP_CATS))
+SHIFT_MATRIX[np.arange(N_POP_CATS), POPULATION_LAYOUT.shift_target] = 1.0
+
+SIZE_INFECT_COEFFICIENTS = np.array(CITY_SIZE_INFECT_COEFFICIENTS)
+
+
+def shift_groups(groups):
+    # weekly shift of a (n_cities, 32) group array, in place
+    groups[:] = groups @ SHIFT_MATRIX
+
+
+def mix64(z):
+    # engine.mix64 on uint64 arrays, overflow wraps around
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def stream_offsets(ids):
+    return (ids.astype(np.uint64) + np.uint64(1)) * np.uint64(GOLDEN_GAMMA)
+
+def stream_uniforms(keys, counters, k):
+    # next k values of every city stream, same numbers as engine.CityStream
+    z = mix64(keys[:, None] + stream_offsets(counters[:, None] + np.arange(k)))
+    return (z >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+def stream_keys(root, ids):
+    # engine.stream_key for many stream ids
+    return mix64(np.uint64(root) + stream_offsets(ids))
+
+
+def spacings(values):
+    # engine.spacings of every row
+    return np.diff(np.sort(values, axis=1), axis=1, prepend=0.0)
+
+def capped_split(quota, capacities, values):
+    # engine.capped_split for many cities at once, one row per city; a row
+    # still overflowing in round k has had k overflows, so it takes the same
+    # columns of values as the scalar version
+    n = capacities.shape[1]
+    groups = (quota[:, None] * spacings(values[:, :n])).astype(np.int64)
+    groups[:, 0] += quota - groups.sum(axis=1)
+
+    good = np.ones(capacities.shape, dtype=bool)
+    start = n
+    for m in range(n - 1, 0, -1):
+        over = groups > capacities
+        rows = np.flatnonzero(over.any(axis=1))
+        if len(rows) == 0:
+            break
+        cut = over[rows].argmax(axis=1)
+        delta = groups[rows, cut] - capacities[rows, cut]
+        groups[rows, cut] = capacities[rows, cut]
+        good[rows, cut] = False
+
+        cur_delta = (delta[:, None] * spacings(values[rows, start:start + m])).astype(np.int64)
+        cur_delta[:, 0] += delta - cur_delta.sum(axis=1)
+        # the m groups not cut yet of every row, in increasing order
+        cols = np.nonzero(good[rows])[1].reshape(len(rows), m)
+        groups[rows[:, None], cols] += cur_delta
+        start += m
+    return groups
+
+
+class BatchCountry(object):
+    # per city state arrays and country economics
+    STATE_ARRAYS = ("city_ids", "groups", "total", "size_type", "transport_density",
+                    "vaccination_quota", "is_epidemic", "stream_keys", "stream_counters")
+    ECONOMICS = ("vaccination_cost", "relief_cost", "current_funds", "tax_per_soul")
+
+    def __init__(self, n_cities=0, seed=None):
+        # Country city ids of the rows
+        self.city_ids = np.arange(n_cities, dtype=np.int64)
+        self.groups = np.zeros((n_cities, N_POP_CATS), dtype=np.int64)
+        self.total = np.zeros(n_cities, dtype=np.int64)
+        self.size_type = np.zeros(n_cities, dtype=np.int64)
+        self.transport_density = np.ones(n_cities)
+        self.vaccination_quota = np.zeros(n_cities, dtype=np.int64)
+        self.is_epidemic = np.zeros(n_cities, dtype=bool)
+
+        self.vaccination_cost = 0.0
+        self.relief_cost = 0.0
+        self.current_funds = 0.0
+        self.tax_per_soul = 0.0
+        # engine.BUDGET_POLICIES, "sequential" is served like "first-come"
+        # in row order from the funds of the start of the week
+        self.budget_policy = "sequential"
+
+        # per city streams (engine.CityStream) when seeded, shared generator otherwise
+        self.rng = np.random.default_rng()
+        self.stream_keys = None
+        self.stream_counters = None
+        if seed is not None:
+            self.set_seed(seed)
+
+        # mobility.MobilityMatrix over the rows, None for isolated cities
+        self.mobility = None
+        self.imported_infected = 0
+
+    def set_seed(self, seed):
+        # same streams as Country.set_seed gives to the cities with these ids
+        if seed is None:
+            self.stream_keys = None
+            self.stream_counters = None
+        else:
+            self.stream_keys = stream_keys(seed_root(seed), self.city_ids)
+            self.stream_counters = np.zeros(self.get_n_cities(), dtype=np.int64)
+
+    def draw(self, k):
+        # k uniform numbers per city
+        if self.stream_keys is None:
+            return self.rng.random((self.get_n_cities(), k))
+        values = stream_uniforms(self.stream_keys, self.stream_counters, k)
+        self.stream_counters += k
+        return values
+
+    @classmethod
+    def from_country(cls, country, seed=None):
+        batch = cls(len(country.cities))
+        batch.city_ids[:] = [city.city_id for city in country.cities]
+        streams = [city.population.rng for city in country.cities]
+        if seed is not None:
+            batch.set_seed(seed)
+        elif streams and all(isinstance(stream, CityStream) for stream in streams):
+            batch.stream_keys = np.array([stream.key for stream in streams], dtype=np.uint64)
+            batch.stream_counters = np.array([stream.counter for stream in streams], dtype=np.int64)
+
+        for i, city in enumerate(country.cities):
+            batch.groups[i] = city.population.population_groups
+            batch.total[i] = city.population.get_total()
+            batch.size_type[i] = city.size_type
+            batch.transport_density[i] = city.transport_density
+            batch.vaccination_quota[i] = city.vaccination_quota
+        batch.update_epidemic()
+        batch.mobility = country.get_mobility_matrix()
+
+        batch.vaccination_cost = country.vaccination_cost
+        batch.relief_cost = country.relief_cost
+        batch.current_funds = country.current_funds
+        batch.tax_per_soul = country.tax_per_soul
+        batch.budget_policy = country.budget_policy
+        return batch
+
+    def write_back(self, country):
+        # copy simulated state back into the city objects
+        for i, city_id in enumerate(self.city_ids):
+            city = country.get_city(int(city_id))
+            city.population.set_groups(self.groups[i].tolist())
+            city.update_epidemic()
+            if self.stream_keys is not None:
+                city.population.set_rng(CityStream(int(self.stream_keys[i]), int(self.stream_counters[i])))
+        country.current_funds = self.current_funds
+        country.totals = None
+
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.ECONOMICS}
+        for name in self.STATE_ARRAYS:
+            value = getattr(self, name)
+            snapshot[name] = value.copy() if value is not None else None
+        return snapshot
+
+    def restore(self, snapshot):
+        # in place, arrays keep their buffers
+        for name in self.ECONOMICS:
+            setattr(self, name, snapshot[name])
+        for name in self.STATE_ARRAYS:
+            value = getattr(self, name)
+            if value is not None and snapshot[name] is not None and len(value) == len(snapshot[name]):
+                value[...] = snapshot[name]
+            else:
+                setattr(self, name, snapshot[name].copy() if snapshot[name] is not None else None)
+
+    def get_n_cities(self):
+        return len(self.groups)
+
+    # per city aggregates, same groups as Population.get_*_population
+    def get_aggregates(self, names=AGGREGATES):
+        # selected aggregates of every city in one pass over the groups
+        columns = [AGGREGATE_COLUMN[name] for name in names]
+        values = self.groups @ AGGREGATE_MATRIX[:, columns]
+        return {name: values[:, k] for k, name in enumerate(names)}
+
+    def get_aggregate(self, name):
+        return self.groups @ AGGREGATE_MATRIX[:, AGGREGATE_COLUMN[name]]
+
+    def get_taxable_population(self):
+        return self.get_aggregate("taxable")
+
+    def get_relief_population(self):
+        return self.get_aggregate("relief")
+
+    def get_infected_population(self):
+        return self.get_aggregate("infected")
+
+    def get_vaccinated_population(self):
+        return self.get_aggregate("vaccinated")
+
+    def get_immune_population(self):
+        return self.get_aggregate("immune")
+
+    # country totals
+    def get_total_population(self):
+        return int(self.total.sum())
+
+    def get_total_infected(self):
+        return int(self.get_infected_population().sum())
+
+    def get_total_vaccinated(self):
+        return int(self.get_vaccinated_population().sum())
+
+    def get_total_immune(self):
+        return int(self.get_immune_population().sum())
+
+    def pass_week(self):
+        shift_groups(self.groups)
+
+    def vaccinate(self, quota):
+        vaccinable_groups = self.groups[:, :2]
+        quota = np.minimum(quota, vaccinable_groups.sum(axis=1))
+
+        d = self.draw(1)[:, 0]
+        g1 = (quota * d).astype(np.int64)
+        g2 = quota - g1
+        over1 = np.maximum(g1 - vaccinable_groups[:, 0], 0)
+        g1 -= over1
+        g2 += over1
+        over2 = np.maximum(g2 - vaccinable_groups[:, 1], 0)
+        g2 -= over2
+        g1 += over2
+
+        self.groups[:, 0] -= g1
+        self.groups[:, 1] -= g2
+        self.groups[:, 2] += g1
+        self.groups[:, 3] += g2
+        return quota
+
+    def infect(self, quota):
+        infectable_groups = self.groups[:, :6]
+        infectable = infectable_groups.sum(axis=1)
+        quota = np.minimum(quota, infectable)
+
+        # random split of the quota between the 6 infectable groups,
+        # always "capped", the retry loop draws a varying amount of numbers
+        groups = capped_split(quota, infectable_groups, self.draw(CAPPED_SPLIT_DRAWS))
+
+        self.groups[:, :6] -= groups
+
+        # decide infection duration
+        durations = [(INFECTION_DURATION[j] * groups).astype(np.int64) for j in range(3)]
+        durations[0] += groups - sum(durations)
+        for j in range(3):
+            self.groups[:, (j+1)*8:(j+1)*8+6] += durations[j]
+
+        return quota
+
+    def standard_process(self, cur_month):
+        totals = self.get_aggregates(("infected", "vaccinated"))
+        infected = totals["infected"] + self.imported_infected
+        total = self.total
+        vaccinated = totals["vaccinated"]
+        new_infected = infected * np.divide(total - vaccinated, total, out=np.zeros(len(total)), where=total > 0)
+        new_infected *= self.transport_density
+        new_infected *= SIZE_INFECT_COEFFICIENTS[self.size_type]
+        new_infected *= 1 + ((total / CITY_MAX_POPULATION) ** 2) / 10
+        new_infected *= MONTH_INFECTION_COEFFICIENTS[cur_month]
+        new_infected = (new_infected * (self.draw(1)[:, 0] / 4 + (7 / 8))).astype(np.int64)
+
+        self.infect(new_infected)
+
+    def update_epidemic(self):
+        self.is_epidemic = self.get_infected_population() >= self.total * EPIDEMIC_BORDER
+
+    def allocate_vaccines(self, demand):
+        # engine.allocate_budget for all cities at once, out of the funds
+        # available at the start of the week
+        if self.vaccination_cost <= 0:
+            return demand
+        budget = max(0, int(self.current_funds / self.vaccination_cost))
+        if demand.sum() <= budget:
+            return demand
+
+        if self.budget_policy == "proportional":
+            total = int(demand.sum())
+            if budget * int(demand.max()) >= 1 << 62:
+                # exact in python integers when int64 would overflow
+                demand = demand.astype(object)
+            shares = (demand * budget // total).astype(np.int64)
+            remainders = (demand * budget % total).astype(np.float64)
+            order = np.lexsort((self.city_ids, -remainders))
+            shares[order[:budget - int(shares.sum())]] += 1
+            return shares
+
+        if self.budget_policy == "priority":
+            infected = self.get_infected_population()
+            rates = np.divide(infected, self.total, out=np.zeros(len(self.total)), where=self.total > 0)
+            order = np.lexsort((self.city_ids, -rates))
+        elif self.budget_policy == "first-come":
+            order = np.argsort(self.city_ids, kind="stable")
+        else:
+            order = np.arange(len(demand))
+        served_before = np.cumsum(demand[order]) - demand[order]
+        shares = np.empty_like(demand)
+        shares[order] = np.clip(budget - served_before, 0, demand[order])
+        return shares
+
+    def process_time_step(self, cur_month, infection_update_func=Population.standard_process):
+        if infection_update_func is not Population.standard_process:
+            raise ValueError("batch engine supports only Population.standard_process")
+
+        if self.mobility is not None:
+            self.imported_infected = self.mobility.get_imported(self.get_infected_population(), self.total)
+        self.pass_week()
+
+        demand = np.minimum(self.vaccination_quota, self.groups[:, :2].sum(axis=1))
+        vaccinated = self.vaccinate(self.allocate_vaccines(demand))
+
+        self.standard_process(cur_month)
+
+        totals = self.get_aggregates(("taxable", "relief"))
+        delta_funds = self.tax_per_soul * totals["taxable"].astype(np.float64)
+        delta_funds -= self.vaccination_cost * vaccinated
+        delta_funds -= self.relief_cost * totals["relief"]
+        self.current_funds += float(delta_funds.sum())
+
+        self.update_epidemic()
+
+    def get_current_funds(self):
+        return self.current_funds
@@ -1,378 +1,263 @@
 from PySide2 import QtCore, QtGui, QtWidgets
 from PySide2.QtCore import QPointF, QRectF
-from datetime import date, timedelta
-from copy import deepcopy
-from random import random, randrange
+from functools import lru_cache, partial
+from random import randrange
+import numpy as np
 
 from constants import *
-
-
-class Population(object):
-    # Number of population categories
-    N_POP_CATS = 32
-    # level 1: healthy/infected for 1/2/3 weeks
-    # level 2: not vaccinated/vaccinated 1/2/>=3 weeks ago
-    # level 3: working/not working
-
-    def __init__(self, parent_city):
-        self.parent_city = parent_city
-
-        self.total_population = 0
-        self.population_groups = [0 for i in range(self.N_POP_CATS)]
-        self.set_total_population(1000)
-
-    def get_total(self):
-        return self.total_population
-
-    def get_group(self, mask):
-        return sum([self.population_groups[i] for i in range(self.N_POP_CATS) if mask[i]])
-
-    def get_taxable_population(self):
-        mask = [(1 - i % 2) * (i < 8) for i in range(self.N_POP_CATS)]
-        return self.get_group(mask)
-
-    def get_relief_population(self):
-        mask = [(i % 2) * (i > 8) for i in range(self.N_POP_CATS)]
-        return self.get_group(mask)
-
-    def get_infected_population(self):
-        mask = [(i >= 8) for i in range(self.N_POP_CATS)]
-        return self.get_group(mask)
-
-    def get_vaccinated_population(self):
-        mask = [(i % 8) >= 2 for i in range(self.N_POP_CATS)]
-        return self.get_group(mask)
-
-    def get_immune_population(self):
-        mask = [(i % 8) >= 6 for i in range(self.N_POP_CATS)]
-        return self.get_group(mask)                
-
-    def set_total_population(self, new_total):
-        # reset with all healthy not vaccinated
-        self.total_population = int(new_total)
-        self.population_groups = [0 for i in range(self.N_POP_CATS)]
-        working = int(new_total * WORKING_PERCENT)
-        not_working = new_total - working
-        self.population_groups[0] = working
-        self.population_groups[1] = not_working
-
-    def pass_week(self):
-        # shift infected 
-        for i in range(3):
-            for j in range(0, 8):
-                src_index = (i+1)*8+j
-                dst_index = i*8+j
-                #if i == 0:
-                    # now healthy and immune?
-                    #dst_index = 6 + j % 2
-                self.population_groups[dst_index] += self.population_groups[src_index]
-                self.population_groups[src_index] = 0
-
-        # shift vaccinated
-        for i in range(3, 1, -1):
-            for j in range(0, 4):
-                for k in range(2):
-                    src_index = j*8+(i-1)*2+k
-                    dst_index = j*8+i*2+k
-                    self.population_groups[dst_index] += self.population_groups[src_index]
-                    self.population_groups[src_index] = 0
-
-    def vaccinate(self, quota):
-        # -_-'
-        vaccinable_groups = self.population_groups[:2]
-        vaccinable = sum(vaccinable_groups)
-
-        quota = min(quota, vaccinable)
-
-        d = random()
-        g1 = int(quota * d)
-        g2 = quota - g1
-        if g1 > vaccinable_groups[0]:
-            g2 += g1 - vaccinable_groups[0]
-            g1 = vaccinable_groups[0]
-        elif g2 > vaccinable_groups[1]:
-            g1 += g2 - vaccinable_groups[1]
-            g2 = vaccinable_groups[1]
-
-        self.population_groups[0] -= g1
-        self.population_groups[1] -= g2
-
-        self.population_groups[2] += g1
-        self.population_groups[3] += g2
-
-        return quota
-
-    def infect(self, quota):
-        infectable_groups = self.population_groups[:6]
-        infectable = sum(infectable_groups)
-
-        quota = min(quota, infectable)
-
-        def get_destribution(n):
-            pts = [0] + list(sorted([random() for i in range(n)])) + [1]
-            return [pts[i + 1] - pts[i] for i in range(n)]
-
-        # decide who to infect
-        group_coeffs = get_destribution(6)
-        groups = [int(quota * group_coeffs[i]) for i in range(6)]
-        groups[0] += quota - sum(groups)
-
-
-        good = {i for i in range(6)}
-        # check for overflowing and redestribute
-        while True:
-            for i in range(6):
-                if groups[i] > infectable_groups[i]:
-                    good -= {i}
-                    delta = groups[i] - infectable_groups[i]
-                    groups[i] = infectable_groups[i]
-
-                    cur_group_coeffs = get_destribution(len(good))
-                    cur_delta = [int(delta * cur_group_coeffs[j]) for j in range(len(good))]
-                    cur_delta[0] += delta - sum(cur_delta)
-                    for g, j in zip(list(good), range(len(good))):
-                        groups[g] += cur_delta[j]
-                    break
-            else:
-                break
-
-        for i in range(6):
-            self.population_groups[i] -= groups[i]
-
-        # decide infection duration
-        for i in range(6):
-            cur_groups = [int(INFECTION_DURATION[j] * groups[i]) for j in range(3)]
-            cur_groups[0] += groups[i] - sum(cur_groups)
-            for j in range(3):
-                self.population_groups[i+(j+1)*8] += cur_groups[j]
-
-        return quota
-
-
-    def standard_process(self, cur_month):
-        infected = self.get_infected_population()
-        total = self.get_total()
-        vaccinated = self.get_vaccinated_population()
-        new_infected = infected * ((total - vaccinated) / total)
-        new_infected *= self.parent_city.transport_density
-        new_infected *= CITY_SIZE_INFECT_COEFFICIENTS[self.parent_city.size_type]
-        new_infected *= 1 + ((total / CITY_MAX_POPULATION) ** 2) / 10
-        new_infected *= MONTH_INFECTION_COEFFICIENTS[cur_month]
-        new_infected = int(new_infected * (random() / 4 + (7 / 8)))
-
-        #print(new_infected)
-
-        # test
-        # new_infected = int(self.total_population * random() / 3)
-
-        self.infect(new_infected)
-
-    def __str__(self):
-        return ((("{} " * 8) + '\n') * 4).format(*self.population_groups)
-
-
-class City(object):
+from engine import *
+from optimizer import optimize_quotas
+from timeline import Timeline
+from scenario import save_scenario, load_scenario
+from worker import SimulationWorker, Frame
+from spatial import SpatialGrid
+from table import CityTable, DEFAULT_CITY_COLORS, TABLE_AGGREGATE_COLUMN
+
+
+def to_point(pos):
+    return QPointF(*pos)
+
+def from_point(point):
+    return (point.x(), point.y())
+
+
+def get_look(city):
+    # how a city is drawn, besides where
+    color = city.norm_color if not city.is_epidemic else city.epid_color
+    return color, city.alpha, city.infect_color, city.get_infected_radius()
+
+@lru_cache(maxsize=256)
+def get_qcolor(color, alpha=255):
+    # a map has a handful of colors, not one per city
+    qcolor = QtGui.QColor(*color)
+    qcolor.setAlpha(alpha)
+    return qcolor
+
+def draw_look(painter, pos, r, look):
+    color, alpha, infect_color, infect_r = look
+    city_color = get_qcolor(color, alpha)
+    pos = to_point(pos)
+    painter.setPen(city_color)
+    painter.setBrush(city_color)
+    painter.drawEllipse(pos, r, r)
+
+    infect_color = get_qcolor(infect_color)
+    painter.setPen(infect_color)
+    painter.setBrush(infect_color)
+    painter.drawEllipse(pos, infect_r, infect_r)
+
+def draw_city(painter, city):
+    draw_look(painter, city.pos, city.r, get_look(city))
+
+def set_label_values(labels, names, values):
+    # a label is only touched when its text changes
+    for name, label, value in zip(names, labels, values):
+        text = "{}: {}".format(name, value)
+        if label.text() != text:
+            label.setText(text)
+
+def get_transform(view_transform):
+    # QTransform of a (zoom, dx, dy) view: screen = world * zoom + (dx, dy)
+    zoom, dx, dy = view_transform
+    return QtGui.QTransform(zoom, 0, 0, zoom, dx, dy)
+
+def get_heat_color(population, infected, count):
+    # healthy to infected color by the infected share, more opaque when crowded
+    mix = (infected / population) ** 0.7 if population else 0
+    color = QtGui.QColor(*(int(round(a + (b - a) * mix)) for a, b in zip(CITY_NORMAL_COLOR, CITY_INFECTED_COLOR)))
+    color.setAlpha(int(HEATMAP_ALPHA[0] + (HEATMAP_ALPHA[1] - HEATMAP_ALPHA[0]) * min(1, count / HEATMAP_FULL_TILE)))
+    return color
+
+
+class CityShape(object):
+    # where a city is on the map, and its row in the view
+    __slots__ = ("city_id", "row", "pos", "r")
+
+    def __init__(self, city_id, row, pos, r):
+        self.city_id = city_id
+        self.row = row
+        self.pos = pos
+        self.r = r
+
+
+class CityLayer(object):
+    # the visible cities drawn once on a pixmap. A new frame only redraws the
+    # cities whose look changed, clipped to their circle, together with the
+    # neighbours reaching into it; added, removed or moved cities, a resize
+    # or a zoom or pan draw the whole layer again. Below HEATMAP_ZOOM
+    # crowded tiles are drawn as one heat square instead of their cities.
+    # A frame is compared with the last one column by column, a Country
+    # city by city
     def __init__(self):
-        self.parent_country = None
-
-        self.population = Population(self)
-        self.size_type = 0
-        self.r = 10
-
-        self.transport_density = 1.0
-        self.is_epidemic = False
-
-        self.vaccination_quota = 0
-
-        self.norm_color = CITY_NORMAL_COLOR
-        self.infect_color = CITY_INFECTED_COLOR
-        self.epid_color = CITY_EPIDEMIC_COLOR
-
-        self.alpha = 255
-
-        self.pos = QPointF(0, 0)
-
-    def draw(self, painter):
-        city_color = self.norm_color if not self.is_epidemic else self.epid_color
-        city_color.setAlpha(self.alpha)
-        painter.setPen(city_color)
-        painter.setBrush(city_color)
-        painter.drawEllipse(self.pos, self.r, self.r)
-        
-        painter.setPen(self.infect_color)
-        painter.setBrush(self.infect_color)
-        infect_r = self.r * ((self.get_infected() / self.get_population()) ** 0.7)
-        painter.drawEllipse(self.pos, infect_r, infect_r)
-
-
-    def update_size(self):
-        self.size_type = 0
-        pop = self.population.get_total()
-        for border in CITY_SIZE_POPULATION:
-            if pop >= border:
-                self.size_type += 1
-            else:
-                break
-        self.r = CITY_SIZES[self.size_type]
-
-    def get_radius(self):
-        return self.r
-
-
-    def set_transport_density(self, value):
-        self.transport_density = float(value)
-
-    def set_pos(self, value):
-        self.pos = QPointF(value)
-
-    def set_population(self, value):
-        self.population.set_total_population(int(value))
-        self.update_size()
-        self.update_epidemic()
-
-    def set_alpha(self, value):
-        self.alpha = int(value)
-
-    def set_parent(self, country):
-        self.parent_country = country
-
-    def get_population(self):
-        return self.population.get_total()
-
-    def get_infected(self):
-        return self.population.get_infected_population()
-
-    def get_vaccinated(self):
-        return self.population.get_vaccinated_population()
-
-    def get_immune(self):
-        return self.population.get_immune_population()
-
-
-    def set_vaccination_quota(self, quota):
-        self.vaccination_quota = quota
-
-    def vaccinate(self, quota):
-        return self.population.vaccinate(quota)
-
-    def infect(self, quota):
-        infected = self.population.infect(quota)
-        self.update_epidemic()
-        return infected
-
-    def update_epidemic(self):
-        infected = self.population.get_infected_population()
-        self.is_epidemic = infected >= self.population.get_total() * EPIDEMIC_BORDER
-
-    def process_time_step(self, cur_month, infection_update_func, funds_quota):
-        # must return funds balance delta from current city
-
-        self.population.pass_week()
-
-        vaccinated = self.vaccinate(min(funds_quota, self.vaccination_quota))
-
-        infection_update_func(self.population, cur_month)
-
-        delta_funds = self.parent_country.tax_per_soul * self.population.get_taxable_population()
-        delta_funds -= self.parent_country.vaccination_cost * vaccinated
-        delta_funds -= self.parent_country.relief_cost * self.population.get_relief_population()
-
-        self.update_epidemic()
-
-        #print(self.population)
-
-        return delta_funds
-
-
-class Country(object):
-    def __init__(self):
-        self.cities = []
-
-        self.vaccination_cost = 0.0
-        self.relief_cost = 0.0
-        self.current_funds = 0.0
-        self.tax_per_soul = 0.0
-
-    def draw(self, painter):
-        for city in self.cities:
-            city.draw(painter)
-
-    def add_city(self, city):
-        self.cities.append(deepcopy(city))
-        self.cities[-1].set_parent(self)
-
-    def remove_city(self, city):
-        if type(city) == City:
-            for i in range(len(self.cities)):
-                if self.cities[i] is city:
-                    city = i
-                    break
+        self.pixmap = None
+        self.view_transform = None
+        self.heatmap = False
+        # every city of the map by row, also the ones out of sight
+        self.shapes = []
+        self.grid = SpatialGrid()
+        # table.CityTable of the last frame, None for a Country
+        self.table = None
+        # looks of the rows, a list for a Country and columns for a table
+        self.looks = []
+
+    def get_looks(self, rows):
+        if self.table is None:
+            return [self.looks[row] for row in rows]
+        is_epidemic, alpha, infected_radius, colors = self.looks
+        looks = []
+        for row, epidemic, a, radius in zip(rows, is_epidemic[rows].tolist(), alpha[rows].tolist(),
+                                            infected_radius[rows].tolist()):
+            norm_color, infect_color, epid_color = colors.get(row, DEFAULT_CITY_COLORS)
+            looks.append((epid_color if epidemic else norm_color, a, infect_color, radius))
+        return looks
+
+    def compare_cities(self, cities):
+        # (moved, changed shapes, looks) against the last view
+        looks = [get_look(city) for city in cities]
+        shapes = self.shapes
+        if self.table is not None or len(cities) != len(shapes) or \
+                any(shape.city_id != city.city_id or shape.pos != city.pos or shape.r != city.r
+                    for shape, city in zip(shapes, cities)):
+            return True, [], looks
+        return False, [shape for shape, look, old in zip(shapes, looks, self.looks) if look != old], looks
+
+    def compare_table(self, table):
+        # same as compare_cities on whole columns
+        looks = (table.is_epidemic, table.alpha, table.get_infected_radii(), table.colors)
+        old = self.table
+        if old is None or not (np.array_equal(old.city_ids, table.city_ids) and
+                               np.array_equal(old.pos, table.pos) and np.array_equal(old.r, table.r)):
+            return True, [], looks
+        is_epidemic, alpha, infected_radius, colors = self.looks
+        rows = set(np.flatnonzero((looks[0] != is_epidemic) | (looks[1] != alpha) |
+                                  (looks[2] != infected_radius)).tolist())
+        rows.update(row for row in set(colors) | set(table.colors) if colors.get(row) != table.colors.get(row))
+        return False, [self.shapes[row] for row in sorted(rows)], looks
+
+    def set_shapes(self, view):
+        if self.table is not None:
+            places = zip(self.table.city_ids.tolist(), map(tuple, self.table.pos.tolist()), self.table.r.tolist())
         else:
-            city = int(city)
-        del self.cities[city]
-
-    def check_vicinity(self, pos, r):
-        for city in self.cities:
-            if QtGui.QVector2D(city.pos - pos).length() < r + city.r:
-                return False
-        return True
-
-    def find_city(self, pos):
-        for city in self.cities:
-            if QtGui.QVector2D(city.pos - pos).length() < city.r:
-                return city
-        return None
-
-    def process_time_step(self, cur_month, infection_update_func):
-        for city in self.cities:
-            self.current_funds += city.process_time_step(cur_month, infection_update_func, 
-                                  max(0, int(self.current_funds / self.vaccination_cost)))
-
-
-    def get_vaccination_cost(self):
-        return self.vaccination_cost
-
-    def set_vaccination_cost(self, cost):
-        self.vaccination_cost = cost;
-
-    def get_relief_cost(self):
-        return self.relief_cost
-
-    def set_relief_cost(self, cost):
-        self.relief_cost = cost;
-
-    def get_current_funds(self):
-        return self.current_funds
+            places = ((city.city_id, city.pos, city.r) for city in view.cities)
+        self.shapes = [CityShape(city_id, row, pos, r) for row, (city_id, pos, r) in enumerate(places)]
+        self.grid.clear()
+        for shape in self.shapes:
+            self.grid.insert(shape)
+
+    def get_world_rect(self):
+        zoom, dx, dy = self.view_transform
+        w, h = self.pixmap.width(), self.pixmap.height()
+        return -dx / zoom, -dy / zoom, (w - dx) / zoom, (h - dy) / zoom
+
+    def update(self, view, size, view_transform):
+        # a frame is drawn from its table
+        table = view.table if isinstance(view, Frame) else view if isinstance(view, CityTable) else None
+        if table is not None:
+            moved, changed, self.looks = self.compare_table(table)
+        else:
+            moved, changed, self.looks = self.compare_cities(view.cities)
+        self.table = table
+        if moved:
+            self.set_shapes(view)
+
+        full = moved or self.heatmap or self.pixmap is None or self.pixmap.size() != size \
+            or self.view_transform != view_transform
+        if not full and changed:
+            x0, y0, x1, y1 = self.get_world_rect()
+            changed = [shape for shape in changed if shape.pos[0] + shape.r > x0 and shape.pos[0] - shape.r < x1
+                       and shape.pos[1] + shape.r > y0 and shape.pos[1] - shape.r < y1]
+        # past some share of changed cities one pass over all is cheaper
+        if full or len(changed) > len(self.shapes) // 4:
+            self.redraw(view, size, view_transform)
+        elif changed:
+            margin = 1 / view_transform[0]
+            painter = QtGui.QPainter(self.pixmap)
+            painter.setTransform(get_transform(view_transform))
+            for shape in changed:
+                clip = QtGui.QPainterPath()
+                clip.addEllipse(to_point(shape.pos), shape.r + margin, shape.r + margin)
+                painter.setClipPath(clip)
+                painter.setCompositionMode(QtGui.QPainter.CompositionMode_Clear)
+                painter.fillPath(clip, QtCore.Qt.transparent)
+                painter.setCompositionMode(QtGui.QPainter.CompositionMode_SourceOver)
+                self.draw_shapes(painter, list(self.grid.query(shape.pos, shape.r + margin)))
+            painter.end()
+
+    def redraw(self, view, size, view_transform):
+        self.pixmap = QtGui.QPixmap(size)
+        self.pixmap.fill(QtCore.Qt.transparent)
+        self.view_transform = view_transform
+        visible = list(self.grid.query_rect(*self.get_world_rect()))
+
+        painter = QtGui.QPainter(self.pixmap)
+        self.heatmap = view_transform[0] < HEATMAP_ZOOM
+        if self.heatmap:
+            visible = self.draw_heatmap(painter, view, visible)
+        painter.setTransform(get_transform(view_transform))
+        self.draw_shapes(painter, visible)
+        painter.end()
 
-    def set_current_funds(self, funds):
-        self.current_funds = funds;
+    def draw_shapes(self, painter, shapes):
+        looks = self.get_looks([shape.row for shape in shapes])
+        for shape, look in zip(shapes, looks):
+            draw_look(painter, shape.pos, shape.r, look)
+
+    def draw_heatmap(self, painter, view, shapes):
+        # fills the tiles holding HEATMAP_MIN_CITIES or more cities, returns
+        # the cities left to draw one by one
+        if not shapes:
+            return shapes
+        zoom, dx, dy = self.view_transform
+        pos = np.array([shape.pos for shape in shapes], dtype=np.float64)
+        tiles = np.floor((pos * zoom + (dx, dy)) / HEATMAP_TILE).astype(np.int64)
+        keys = (tiles[:, 0] << 32) + tiles[:, 1]
+        keys, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        crowded = counts[inverse] >= HEATMAP_MIN_CITIES
+        if not crowded.any():
+            return shapes
+
+        members = np.flatnonzero(crowded)
+        rows = [shapes[i].row for i in members.tolist()]
+        if self.table is not None:
+            population = self.table.total[rows]
+            infected = self.table.aggregates[rows, TABLE_AGGREGATE_COLUMN["infected"]]
+        else:
+            cities = [view.cities[row] for row in rows]
+            population = [city.get_population() for city in cities]
+            infected = [city.get_infected() for city in cities]
+        population = np.bincount(inverse[members], population, len(keys))
+        infected = np.bincount(inverse[members], infected, len(keys))
+        for k in np.flatnonzero(counts >= HEATMAP_MIN_CITIES).tolist():
+            x, y = tiles[first[k]].tolist()
+            painter.fillRect(x * HEATMAP_TILE, y * HEATMAP_TILE, HEATMAP_TILE, HEATMAP_TILE,
+                             get_heat_color(population[k], infected[k], counts[k]))
+        return [shape for shape, aggregated in zip(shapes, crowded.tolist()) if not aggregated]
 
-    def get_tax(self):
-        return self.tax_per_soul
+    def draw(self, painter):
+        painter.drawPixmap(0, 0, self.pixmap)
 
-    def set_tax(self, tax):
-        self.tax_per_soul = tax;
 
 ###############################################################
 class SimulationWidget(QtWidgets.QWidget):
     SelectedCity = QtCore.Signal(bool)
     SimulationState = QtCore.Signal(str)
+    # current week, last recorded week
+    TimelineChanged = QtCore.Signal(int, int)
+    # callable to run on the worker thread
+    EngineCall = QtCore.Signal(object)
 
     def __init__(self, country, parent = None):
         QtWidgets.QWidget.__init__(self, parent)
         self.setMouseTracking(True)
 
-        self.country = country
+        self.simulation = Simulation(country)
+        self.simulation.set_timeline(Timeline())
 
         self.param_labels = []
         self.new_city_labels = []
         self.cur_city_labels = []
 
-        # simulation parameters
-        self.simulation_period = BASE_SIMULATION_PERIOD # in weeks
-        self.simulation_start_date = START_DATE
-        self.infection_update_func = (lambda city: city)
-
         # city creation parameters
         self.new_city = City()
         self.new_city.set_alpha(NEW_CITY_ALPHA)
@@ -380,42 +265,76 @@ class SimulationWidget(QtWidgets.QWidget):
         self.new_infect = 0
         self.new_vaccinate = 0
 
-        self.selected_city = None
+        self.selected_city_id = None
 
         self.gui_page = 0
 
+        # cities are drawn from a cached layer; a repaint only for the
+        # preview city leaves the layer as it is
+        self.city_layer = CityLayer()
+        self.overlay_only = False
+
+        # map view: screen = world * zoom + offset; the right or the middle
+        # button drags it
+        self.zoom = 1.0
+        self.offset = (0.0, 0.0)
+        self.pan_start = None
+
         self.clock_interval = 1000
-        self.clock = QtCore.QTimer()
-        self.clock.setInterval(1000)
-        self.clock.timeout.connect(self.process_time_step)
+
+        # the worker steps the simulation on its own thread and sends frames
+        # to draw; the engine is only touched here directly while preparing,
+        # when the worker has nothing to run
+        self.frame = None
+        self.worker = SimulationWorker(self.simulation)
+        self.worker_thread = QtCore.QThread()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker.FrameReady.connect(self.show_frame)
+        self.EngineCall.connect(self.worker.call, QtCore.Qt.BlockingQueuedConnection)
+        self.worker_thread.start()
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop_worker)
         self.clock_control_buttons = []
+        self.fast_forward_button = None
 
-        self.preparing = True
         self.simulating = False
-        self.finished = False
-        self.start_time = DEFAULT_START_DATE
-        self.time = self.start_time
-        self.simulation_duration = 6
-        time_delta = timedelta(days=self.simulation_duration * MONTH_DURATION)
-        self.finish_time = self.start_time + time_delta
 
         self.preparation_only_elems = []
 
-        self.bckp_country = deepcopy(country)
+    # simulation state lives in the engine
+    @property
+    def country(self):
+        return self.simulation.country
+
+    @property
+    def preparing(self):
+        return self.simulation.preparing
 
+    @property
+    def finished(self):
+        return self.simulation.finished
+
+    # selection is kept by city id, so it survives a reset
+    @property
+    def selected_city(self):
+        if self.selected_city_id is None:
+            return None
+        return self.country.get_city(self.selected_city_id)
 
     def containsNewCity(self):
         w, h = self.width(), self.height()
         bounding_rect = QRectF(5, 5, w - 10, h - 10)
         r = self.new_city.get_radius()
-        city_rect = QRectF(self.new_city.pos - QPointF(r, r), QtCore.QSize(2*r, 2*r))
+        city_rect = QRectF(to_point(self.new_city.pos) - QPointF(r, r), QtCore.QSize(2*r, 2*r))
         return bounding_rect.contains(city_rect)
 
     def has_space_to_place(self):
         return self.country.check_vicinity(self.new_city.pos, self.new_city.r)
 
     def select_city(self, pos):
-        self.selected_city = self.country.find_city(pos)
+        city = self.country.find_city(from_point(pos))
+        self.selected_city_id = city.city_id if city is not None else None
         self.SelectedCity.emit(self.selected_city is not None)
         if self.selected_city is not None:
             self.setFocus()
@@ -424,7 +343,7 @@ class SimulationWidget(QtWidgets.QWidget):
         if (self.selected_city is not None):
             self.country.remove_city(self.selected_city)
 
-            self.selected_city = None
+            self.selected_city_id = None
             self.SelectedCity.emit(False)
             self.repaint()
 
@@ -436,20 +355,26 @@ class SimulationWidget(QtWidgets.QWidget):
         painter = QtGui.QPainter()
         painter.begin(self)
 
-        painter.drawRect(bounding_rect)
+        view = self.get_view()
+        view_transform = self.get_view_transform()
+        if not self.overlay_only or self.city_layer.pixmap is None:
+            self.city_layer.update(view, self.size(), view_transform)
+        self.city_layer.draw(painter)
 
-        self.country.draw(painter)
+        painter.setTransform(get_transform(view_transform))
+        painter.drawRect(bounding_rect)
 
         if self.gui_page == 1:
             if self.preparing and self.containsNewCity():
-                self.new_city.draw(painter)
+                draw_city(painter, self.new_city)
                 if not self.has_space_to_place():
-                    pos, r = self.new_city.pos, self.new_city.r
+                    pos, r = to_point(self.new_city.pos), self.new_city.r
 
                     new_pen = QtGui.QPen()
                     color = QtGui.QColor(255, 0, 0) # Red
                     new_pen.setColor(color)
                     new_pen.setWidth(3)
+                    new_pen.setCosmetic(True)
                     painter.setPen(new_pen)
                     painter.drawEllipse(pos, r, r)
 
@@ -460,54 +385,85 @@ class SimulationWidget(QtWidgets.QWidget):
                       self.new_city.transport_density
                       ]
             names = ["Population", "Infected", "Vaccination quota", "Vaccinated", "Transport density"]
-            for name, label, value in zip(names, self.new_city_labels, values):
-                label.setText("{}: {}".format(name, value))            
-        if self.selected_city is not None:
-            pos, r = self.selected_city.pos, self.selected_city.r
+            set_label_values(self.new_city_labels, names, values)
+        selected_city = view.get_city(self.selected_city_id) if self.selected_city_id is not None else None
+        if selected_city is not None:
+            pos, r = to_point(selected_city.pos), selected_city.r
+            select_color = QtGui.QColor(*CITY_SELECT_COLOR)
 
             new_pen = QtGui.QPen()
-            new_pen.setColor(CITY_SELECT_COLOR)
+            new_pen.setColor(select_color)
             new_pen.setWidth(3)
+            new_pen.setCosmetic(True)
             painter.setPen(new_pen)
             painter.setBrush(QtGui.QColor(0, 0, 0, 0))
             painter.drawEllipse(pos, r, r)
 
             r = min(r / 3, 10)
-            painter.setBrush(CITY_SELECT_COLOR)
+            painter.setBrush(select_color)
             painter.drawEllipse(pos, r, r)
 
-            values = [self.selected_city.get_population(),
-                      self.selected_city.get_infected(), 
-                      self.selected_city.vaccination_quota,
-                      self.selected_city.get_vaccinated(),
-                      self.selected_city.get_immune(),
-                      self.selected_city.transport_density
+            values = [selected_city.get_population(),
+                      selected_city.get_infected(), 
+                      selected_city.vaccination_quota,
+                      selected_city.get_vaccinated(),
+                      selected_city.get_immune(),
+                      selected_city.transport_density
                       ]
             names = ["Population", "Infected", "Vaccination quota", "Vaccinated", "Immune", "Transport density"]
-            for name, label, value in zip(names, self.cur_city_labels, values):
-                label.setText("{}: {}".format(name, value))
+            set_label_values(self.cur_city_labels, names, values)
 
-        values = [self.country.get_current_funds(),
-                  self.country.get_tax(),
-                  self.country.get_vaccination_cost(),
-                  self.country.get_relief_cost(),
+        if view is self.frame:
+            time, duration = view.time, view.duration
+        else:
+            time, duration = self.simulation.clock.time, self.simulation.clock.duration
+        values = [view.get_current_funds(),
+                  view.get_tax(),
+                  view.get_vaccination_cost(),
+                  view.get_relief_cost(),
                   self.clock_interval / 1000,
 
-                  "{} {}".format(MONTHS[self.time.month], self.time.day),
-                  sum(map(City.get_population, self.country.cities)),
-                  sum(map(City.get_infected, self.country.cities)),
-                  sum(map(City.get_vaccinated, self.country.cities)),
-                  sum(map(City.get_immune, self.country.cities)),
+                  "{} {}".format(MONTHS[time.month], time.day),
+                  view.get_total_population(),
+                  view.get_total_infected(),
+                  view.get_total_vaccinated(),
+                  view.get_total_immune(),
 
-                  self.simulation_duration
+                  duration
                   ]
         names = ["Current funds", "Taxes per person", "Vaccination cost", "Relief", "Step interval (seconds)",
                  "Current time", "Total population", "Total infected", "Total vaccinated", "Total immune",
                  "Duration (months)"]
-        for name, label, value in zip(names, self.param_labels, values):
-            label.setText("{}: {}".format(name, value))
+        set_label_values(self.param_labels, names, values)
 
         painter.end()
+        if view is self.frame:
+            self.worker.frame_done()
+
+    # map view
+    def get_view_transform(self):
+        return (self.zoom, self.offset[0], self.offset[1])
+
+    def to_world(self, point):
+        return QPointF((point.x() - self.offset[0]) / self.zoom, (point.y() - self.offset[1]) / self.zoom)
+
+    def zoom_at(self, point, factor):
+        # keeps the world point under the cursor in place
+        x, y = from_point(self.to_world(point))
+        self.zoom = min(max(self.zoom * factor, ZOOM_RANGE[0]), ZOOM_RANGE[1])
+        self.offset = (point.x() - x * self.zoom, point.y() - y * self.zoom)
+        self.update()
+
+    def reset_view(self):
+        self.zoom = 1.0
+        self.offset = (0.0, 0.0)
+        self.update()
+
+    def get_view(self):
+        # latest frame once the simulation runs, the country while preparing
+        if self.frame is not None and not self.preparing:
+            return self.frame
+        return self.country
 
     # global params management
     def set_param_labels(self, labels):
@@ -518,20 +474,20 @@ class SimulationWidget(QtWidgets.QWidget):
         self.repaint()
 
     def set_tax(self, tax):
-        self.country.set_tax(tax)
+        self.engine_edit(self.country.set_tax, tax)
         self.repaint()
 
     def set_vaccination_cost(self, cost):
-        self.country.set_vaccination_cost(cost)
+        self.engine_edit(self.country.set_vaccination_cost, cost)
         self.repaint()
 
     def set_relief_cost(self, cost):
-        self.country.set_relief_cost(cost)
+        self.engine_edit(self.country.set_relief_cost, cost)
         self.repaint()
 
     def set_clock_interval(self, delta):
         self.clock_interval = 1000 * delta
-        self.clock.setInterval(self.clock_interval)
+        self.engine_call(self.worker.set_interval, self.clock_interval)
         self.repaint()
 
     # selected city params management
@@ -545,22 +501,22 @@ class SimulationWidget(QtWidgets.QWidget):
 
     def infect_cur(self, quota):
         if self.selected_city is not None and not self.finished:
-            self.selected_city.infect(quota)
+            self.engine_edit(self.selected_city.infect, quota)
         self.repaint()
 
     def vaccinate_cur(self, quota):
         if self.selected_city is not None and not self.finished:
-            self.selected_city.vaccinate(quota)
+            self.engine_edit(self.selected_city.vaccinate, quota)
         self.repaint()
 
     def set_cur_vaccination_quota(self, quota):
         if self.selected_city is not None and not self.finished:
-            self.selected_city.set_vaccination_quota(quota)
+            self.engine_edit(self.selected_city.set_vaccination_quota, quota)
         self.repaint()
 
     def set_cur_transport_density(self, value):
         if self.selected_city is not None and not self.finished:
-            self.selected_city.set_transport_density(value)
+            self.engine_edit(self.selected_city.set_transport_density, value)
         self.repaint()
 
     # new city management
@@ -590,6 +546,40 @@ class SimulationWidget(QtWidgets.QWidget):
         self.repaint()
 
 
+    def optimize_quotas(self):
+        if self.preparing and self.country.cities:
+            optimize_quotas(self.country, self.simulation.clock)
+        self.repaint()
+
+
+    def save_scenario(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save scenario", "", SCENARIO_FILE_FILTER)
+        if path:
+            # written on the worker between two steps, never from a half-stepped week
+            try:
+                self.engine_call(lambda: save_scenario(path, self.simulation.country, self.simulation.clock))
+            except (OSError, ValueError) as error:
+                self.SimulationState.emit(str(error))
+
+    def load_scenario(self):
+        # returns True if a scenario was loaded
+        if not self.preparing:
+            return False
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Load scenario", "", SCENARIO_FILE_FILTER)
+        if not path:
+            return False
+        try:
+            scenario = load_scenario(path)
+        except (OSError, ValueError) as error:
+            self.SimulationState.emit(str(error))
+            return False
+        self.simulation.set_country(scenario.to_country())
+        scenario.apply_clock(self.simulation.clock)
+        self.selected_city_id = None
+        self.SelectedCity.emit(False)
+        self.repaint()
+        return True
+
     def update_new_city(self):
         self.new_city.set_population(self.new_city.get_population())
         self.new_city.vaccinate(self.new_vaccinate)
@@ -597,7 +587,9 @@ class SimulationWidget(QtWidgets.QWidget):
 
     ###
     def keyPressEvent(self, event):
-        if not self.finished:
+        if event.key() == QtCore.Qt.Key_Home:
+            self.reset_view()
+        elif not self.finished:
             if event.key() == QtCore.Qt.Key_Delete and self.preparing:
                 self.remove_city()
             elif event.key() == QtCore.Qt.Key_Space:
@@ -611,7 +603,9 @@ class SimulationWidget(QtWidgets.QWidget):
 
     def mousePressEvent(self, event):
         self.setFocus()
-        if event.button() == QtCore.Qt.MouseButton.LeftButton:
+        if event.button() in (QtCore.Qt.MouseButton.RightButton, QtCore.Qt.MouseButton.MiddleButton):
+            self.pan_start = (event.pos(), self.offset)
+        elif event.button() == QtCore.Qt.MouseButton.LeftButton:
             if self.gui_page == 1 and self.preparing and self.containsNewCity() :
                 if self.has_space_to_place():
                     self.new_city.set_alpha(CITY_ALPHA)
@@ -620,17 +614,33 @@ class SimulationWidget(QtWidgets.QWidget):
                     self.new_city.set_alpha(NEW_CITY_ALPHA)
                     self.repaint()
             elif self.gui_page == 2:
-                self.select_city(event.pos())
+                self.select_city(self.to_world(event.pos()))
                 self.repaint()
 
+    def mouseReleaseEvent(self, event):
+        if event.button() in (QtCore.Qt.MouseButton.RightButton, QtCore.Qt.MouseButton.MiddleButton):
+            self.pan_start = None
+
+    def wheelEvent(self, event):
+        self.zoom_at(event.pos(), ZOOM_STEP ** (event.angleDelta().y() / 120))
+
     def mouseMoveEvent(self, event):
-        self.new_city.set_pos(QPointF(event.pos()))
+        if self.pan_start is not None:
+            start, offset = self.pan_start
+            self.offset = (offset[0] + event.x() - start.x(), offset[1] + event.y() - start.y())
+            self.update()
+            return
+        self.new_city.set_pos(from_point(self.to_world(event.pos())))
         if self.gui_page == 1:
+            # only the preview moved; while running there is no preview and a
+            # frame waiting to be drawn has to reach the layer
+            self.overlay_only = self.preparing
             self.repaint()
+            self.overlay_only = False
 
 
     def set_infection_func(self, func):
-        self.infection_update_func = func
+        self.simulation.set_infection_func(func)
 
     def gui_page_change(self, value):
         self.gui_page = value
@@ -641,48 +651,93 @@ class SimulationWidget(QtWidgets.QWidget):
     def set_clock_control_buttons(self, buttons):
         self.clock_control_buttons = buttons
 
-    def process_time_step(self):
+    # worker thread
+    def engine_call(self, func, *args):
+        # runs func(*args) on the worker thread between two steps
+        self.EngineCall.emit(partial(func, *args))
+        return self.worker.take_result()
+
+    def engine_edit(self, func, *args):
+        # engine_call for changes the window should show at once
+        return self.engine_call(self.worker.edit, partial(func, *args))
+
+    def stop_worker(self):
+        self.engine_call(self.worker.stop)
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+
+    def show_frame(self, frame):
         if self.preparing:
-            self.init_simulation()
-        self.country.process_time_step(self.time.month, self.infection_update_func)
-        if (self.country.current_funds < 0):
-            self.finish_simulation()
-            self.SimulationState.emit("Simulation finished: flat-broke")
-        self.time += SIMULATION_STEP
-        if (self.time >= self.finish_time):
+            # sent before a reset
+            self.worker.frame_done()
+            return
+        self.frame = frame
+        if frame.state is not None:
             self.finish_simulation()
-            self.SimulationState.emit("Simulation finished: time is up")
-        self.repaint()
+            self.SimulationState.emit(frame.state)
+        self.TimelineChanged.emit(frame.week, frame.last_week)
+        self.update()
+
+    def emit_timeline(self):
+        self.TimelineChanged.emit(self.simulation.clock.get_week(), self.simulation.timeline.get_last_week())
+
+    def seek_week(self, week):
+        # scrub to a recorded week, stepping from there branches the run
+        if self.preparing or self.frame is None or week == self.frame.week or week > self.frame.last_week:
+            return
+        self.stop_simulation()
+        self.engine_call(self.worker.seek, week)
+        if self.finished:
+            self.set_time_buttons_state([False, False, False, True])
+        else:
+            self.SimulationState.emit("Simulation in process")
+
+    def set_fast_forward_button(self, button):
+        self.fast_forward_button = button
 
     def set_time_buttons_state(self, states):
         for button, state in zip(self.clock_control_buttons, states):
             button.setEnabled(state)
+        # fast-forward goes along with start
+        if self.fast_forward_button is not None:
+            self.fast_forward_button.setEnabled(self.clock_control_buttons[0].isEnabled())
 
     def start_simulation(self):
-        self.process_time_step()
-        self.clock.start()
+        if self.preparing:
+            self.init_simulation()
+        self.engine_call(self.worker.step)
+        self.engine_call(self.worker.start)
+        self.simulating = True
+        self.set_time_buttons_state([False, True, False])
+
+    def fast_forward_simulation(self):
+        # run to the end, drawing at most FAST_FORWARD_FPS frames a second
+        if self.preparing:
+            self.init_simulation()
+        self.engine_call(self.worker.fast_forward)
         self.simulating = True
         self.set_time_buttons_state([False, True, False])
 
     def stop_simulation(self):
-        self.clock.stop()
+        self.engine_call(self.worker.stop)
         self.simulating = False
         self.set_time_buttons_state([True, False, True])
 
     def step_simulation(self):
         self.stop_simulation()
-        self.process_time_step()
+        if self.preparing:
+            self.init_simulation()
+        self.engine_call(self.worker.step)
 
 
     def set_start_month(self, month):
         if self.preparing:
-            self.start_time = date(DEFAULT_START_DATE.year, month + 1, DEFAULT_START_DATE.day)
-            self.time = self.start_time
+            self.simulation.clock.set_start_month(month + 1)
         self.repaint()
 
     def set_simulation_duration(self, duration):
         if self.preparing:
-            self.simulation_duration = duration
+            self.simulation.clock.set_duration(duration)
         self.repaint()
 
 
@@ -690,10 +745,7 @@ class SimulationWidget(QtWidgets.QWidget):
         self.preparation_only_elems = elems
 
     def init_simulation(self):
-        self.bckp_country = deepcopy(self.country)
-        time_delta = timedelta(self.simulation_duration * MONTH_DURATION)
-        self.finish_time = self.start_time + time_delta
-        self.preparing = False
+        self.engine_call(self.worker.init_simulation)
         self.SimulationState.emit("Simulation in process")
         self.clock_control_buttons[-1].setEnabled(True)
 
@@ -701,18 +753,16 @@ class SimulationWidget(QtWidgets.QWidget):
             elem.setEnabled(False)
 
     def finish_simulation(self):
-        self.finished = True
         self.stop_simulation()
         self.set_time_buttons_state([False, False, False, True])
 
     def reset_simulation(self):
-        self.preparing = True
-        self.finished = False
+        self.engine_call(self.worker.reset)
+        self.frame = None
         self.SimulationState.emit("Preparing for simulation")
         self.stop_simulation()
-        self.time = self.start_time
-        self.country = deepcopy(self.bckp_country)
         self.set_time_buttons_state([True, False, True, False])
+        self.emit_timeline()
 
         for elem in self.preparation_only_elems:
             elem.setEnabled(True)
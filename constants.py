@@ -1,4 +1,3 @@
-from PySide2 import QtCore, QtGui
 from datetime import date, timedelta
 
 WINDOW_SIZE = (1200, 600)
@@ -7,13 +6,29 @@ WINDOW_START_IDENT = (300, 200)
 COUNTRY_SIZE = (500, 500)
 COUNTRY_POS = (650, 50)
 
+# map view: zoom limits and the factor of one wheel step
+ZOOM_RANGE = (0.02, 20.0)
+ZOOM_STEP = 1.25
+
+# below HEATMAP_ZOOM, screen tiles of HEATMAP_TILE pixels holding at least
+# HEATMAP_MIN_CITIES cities are drawn as one square, more opaque up to
+# HEATMAP_FULL_TILE cities
+HEATMAP_ZOOM = 0.5
+HEATMAP_TILE = 8
+HEATMAP_MIN_CITIES = 3
+HEATMAP_FULL_TILE = 16
+HEATMAP_ALPHA = (120, 255)
+
+# frames a second drawn while fast-forwarding
+FAST_FORWARD_FPS = 30
+
 START_DATE = date(2000, 1, 1)
 BASE_SIMULATION_PERIOD = 20 #weeks
 
-CITY_NORMAL_COLOR = QtGui.QColor(50, 200, 50)
-CITY_INFECTED_COLOR = QtGui.QColor(200, 50, 50)
-CITY_EPIDEMIC_COLOR = QtGui.QColor(150, 25, 25)
-CITY_SELECT_COLOR = QtGui.QColor(230, 200, 50)
+CITY_NORMAL_COLOR = (50, 200, 50)
+CITY_INFECTED_COLOR = (200, 50, 50)
+CITY_EPIDEMIC_COLOR = (150, 25, 25)
+CITY_SELECT_COLOR = (230, 200, 50)
 
 CITY_MIN_POPULATION = 100
 CITY_MAX_POPULATION = 30 * 10**6
@@ -38,3 +53,10 @@ INFECTION_DURATION = [0.25, 0.6, 0.15]
 
 CITY_ALPHA = 255
 NEW_CITY_ALPHA = 100
+
+SCENARIO_FILE_FILTER = "Scenarios (*.scn);;All files (*)"
+
+# inter-city coupling: cities closer than the cutoff share this part of
+# their contacts at zero distance, falling linearly to nothing at the cutoff
+MOBILITY_CUTOFF = 150.0
+MOBILITY_STRENGTH = 0.05
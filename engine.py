@@ -0,0 +1,1025 @@
+# Headless simulation engine: population model, cities, country, clock and
+# stepping driver. Nothing here depends on Qt, so it can be used for batch
+# runs on machines without a display.
+
+from array import array
+from datetime import date, timedelta
+from copy import copy
+from math import fsum
+from random import random
+
+from constants import *
+from spatial import SpatialGrid
+
+
+class PopulationLayout(object):
+    # Number of population categories
+    N_POP_CATS = 32
+    # level 1: healthy/infected for 1/2/3 weeks
+    # level 2: not vaccinated/vaccinated 1/2/>=3 weeks ago
+    # level 3: working/not working
+    # group index = infection level * 8 + vaccination level * 2 + not working
+
+    # aggregates every population is asked for
+    AGGREGATES = ("taxable", "relief", "infected", "vaccinated", "immune")
+
+    def __init__(self):
+        n = self.N_POP_CATS
+        self.masks = {
+            "taxable": tuple((1 - i % 2) * (i < 8) for i in range(n)),
+            "relief": tuple((i % 2) * (i > 8) for i in range(n)),
+            "infected": tuple(int(i >= 8) for i in range(n)),
+            "vaccinated": tuple(int((i % 8) >= 2) for i in range(n)),
+            "immune": tuple(int((i % 8) >= 6) for i in range(n)),
+        }
+        self.indices = {name: tuple(i for i in range(n) if mask[i])
+                        for name, mask in self.masks.items()}
+        # aggregates each group contributes to
+        self.membership = [tuple(name for name in self.AGGREGATES if self.masks[name][i])
+                           for i in range(n)]
+        # aggregate changes caused by moving one person from group src to dst
+        self.move_deltas = [[tuple((name, self.masks[name][dst] - self.masks[name][src])
+                                   for name in self.AGGREGATES
+                                   if self.masks[name][dst] != self.masks[name][src])
+                             for dst in range(n)] for src in range(n)]
+
+        # weekly shift: every group moves as a whole to exactly one group
+        self.shift_target = tuple(self.get_shift_target(i) for i in range(n))
+        self.shift_sources = tuple(tuple(src for src in range(n) if self.shift_target[src] == dst)
+                                   for dst in range(n))
+        # aggregate changes caused by the weekly shift, as (src, sign) terms
+        self.shift_deltas = tuple((name, tuple((src, sign) for src in range(n)
+                                               for name_, sign in self.move_deltas[src][self.shift_target[src]]
+                                               if name_ == name))
+                                  for name in self.AGGREGATES)
+
+        # healthy not vaccinated / healthy not immune
+        self.vaccinable = (0, 1)
+        self.infectable = tuple(range(6))
+
+    def index(self, infection, vaccination, not_working):
+        return infection * 8 + vaccination * 2 + not_working
+
+    def get_shift_target(self, i):
+        # one week less of infection, one week more since vaccination
+        infection, vaccination, not_working = i // 8, (i % 8) // 2, i % 2
+        infection = max(infection - 1, 0)
+        if vaccination > 0:
+            vaccination = min(vaccination + 1, 3)
+        return self.index(infection, vaccination, not_working)
+
+    def aggregate(self, groups):
+        # all aggregates in one pass over the groups
+        totals = dict.fromkeys(self.AGGREGATES, 0)
+        for value, names in zip(groups, self.membership):
+            if value:
+                for name in names:
+                    totals[name] += value
+        return totals
+
+
+POPULATION_LAYOUT = PopulationLayout()
+
+
+MASK64 = (1 << 64) - 1
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+def mix64(z):
+    # splitmix64 finalizer
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+def stream_uniform(key, counter):
+    # value number counter of the splitmix64 stream started at key
+    z = mix64((key + (counter + 1) * GOLDEN_GAMMA) & MASK64)
+    return (z >> 11) * (1.0 / (1 << 53))
+
+def seed_root(seed):
+    # numpy is only needed when a seed is set
+    from numpy import uint64
+    from numpy.random import SeedSequence
+    return int(SeedSequence(seed).generate_state(1, uint64)[0])
+
+def stream_key(root, stream_id):
+    # key of the stream_id-th stream spawned from a seed root
+    return mix64((root + (stream_id + 1) * GOLDEN_GAMMA) & MASK64)
+
+
+class CityStream(object):
+    # counter based random stream of one city: the n-th value depends only on
+    # the key and n, so results don't depend on how cities are stepped
+    __slots__ = ("key", "counter")
+
+    def __init__(self, key, counter=0):
+        self.key = key
+        self.counter = counter
+
+    def random(self):
+        self.counter += 1
+        return stream_uniform(self.key, self.counter - 1)
+
+    def copy(self):
+        return CityStream(self.key, self.counter)
+
+
+class GlobalStream(object):
+    # unseeded stream shared by all populations, backed by the random module
+    __slots__ = ()
+
+    def random(self):
+        return random()
+
+    def copy(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+GLOBAL_STREAM = GlobalStream()
+
+
+# ways to split an infection quota between the infectable groups:
+# "retry" redraws random splits while some group overflows,
+# "capped" makes the same random splits from a fixed block of
+# CAPPED_SPLIT_DRAWS numbers, so it can be done for many cities at once
+INFECTION_ALLOCATIONS = ("retry", "capped")
+
+# numbers capped_split takes: 6 for the first split, then 5 + 4 + 3 + 2 + 1
+# for the at most five overflows
+CAPPED_SPLIT_DRAWS = 21
+
+
+def spacings(values):
+    # gaps between the sorted values, from 0 up to the last value
+    pts = [0] + sorted(values) + [1]
+    return [pts[i + 1] - pts[i] for i in range(len(values))]
+
+def get_destribution(n, rng=GLOBAL_STREAM):
+    return spacings([rng.random() for i in range(n)])
+
+
+def retry_split(quota, capacities, coeffs, rng=GLOBAL_STREAM):
+    groups = [int(quota * coeffs[i]) for i in range(6)]
+    groups[0] += quota - sum(groups)
+
+
+    good = {i for i in range(6)}
+    # check for overflowing and redestribute
+    while True:
+        for i in range(6):
+            if groups[i] > capacities[i]:
+                good -= {i}
+                delta = groups[i] - capacities[i]
+                groups[i] = capacities[i]
+
+                cur_group_coeffs = get_destribution(len(good), rng)
+                cur_delta = [int(delta * cur_group_coeffs[j]) for j in range(len(good))]
+                cur_delta[0] += delta - sum(cur_delta)
+                for g, j in zip(list(good), range(len(good))):
+                    groups[g] += cur_delta[j]
+                break
+        else:
+            break
+    return groups
+
+
+def capped_split(quota, capacities, values):
+    # retry_split with its random numbers taken from values, the
+    # CAPPED_SPLIT_DRAWS numbers drawn up front: the first split takes the
+    # first 6, each overflow is cut and spread over the groups not cut yet
+    # by the next ones. Same law as retry_split, at most five rounds since
+    # every round cuts one group for good
+    n = len(capacities)
+    coeffs = spacings(values[:n])
+    groups = [int(quota * coeffs[i]) for i in range(n)]
+    groups[0] += quota - sum(groups)
+
+    good = list(range(n))
+    start = n
+    while True:
+        over = [i for i in range(n) if groups[i] > capacities[i]]
+        if not over:
+            return groups
+        i = over[0]
+        good.remove(i)
+        delta = groups[i] - capacities[i]
+        groups[i] = capacities[i]
+
+        coeffs = spacings(values[start:start + len(good)])
+        start += len(good)
+        cur_delta = [int(delta * coeff) for coeff in coeffs]
+        cur_delta[0] += delta - sum(cur_delta)
+        for g, d in zip(good, cur_delta):
+            groups[g] += d
+
+
+# how the week's vaccine budget is shared between cities:
+# "sequential" steps cities in list order, each spending what the ones
+# before left (and earned); the others split the funds of the start of
+# the week: "first-come" in city id order, "proportional" to demand,
+# "priority" to the highest infected share first
+BUDGET_POLICIES = ("sequential", "first-come", "proportional", "priority")
+
+
+def allocate_budget(policy, budget, demands, city_ids, rates=None):
+    # vaccines for every city out of budget; rates (infected shares) are
+    # only used by "priority", ties go to the lower city id
+    if sum(demands) <= budget:
+        return list(demands)
+    n = len(demands)
+    if policy == "proportional":
+        total = sum(demands)
+        shares = [budget * demand // total for demand in demands]
+        # rounding leaves less than n vaccines, largest remainders get them
+        remainders = sorted(range(n), key=lambda i: (-(budget * demands[i] % total), city_ids[i]))
+        for i in remainders[:budget - sum(shares)]:
+            shares[i] += 1
+        return shares
+    if policy == "priority":
+        order = sorted(range(n), key=lambda i: (-rates[i], city_ids[i]))
+    else:
+        order = sorted(range(n), key=city_ids.__getitem__)
+    shares = [0] * n
+    for i in order:
+        shares[i] = min(demands[i], budget)
+        budget -= shares[i]
+    return shares
+
+
+class Population(object):
+    N_POP_CATS = PopulationLayout.N_POP_CATS
+    layout = POPULATION_LAYOUT
+    DEFAULT_ALLOCATION = "retry"
+    # slots keep a city small, a million of them are kept in memory
+    __slots__ = ("parent_city", "total_population", "population_groups", "totals",
+                 "allocation", "rng", "imported_infected")
+
+    def __init__(self, parent_city):
+        self.parent_city = parent_city
+        self.allocation = self.DEFAULT_ALLOCATION
+        self.rng = GLOBAL_STREAM
+        # infected met in other cities this week, set by the country
+        self.imported_infected = 0
+
+        self.total_population = 0
+        # a typed array, 8 bytes a group and no int objects
+        self.population_groups = array('q', bytes(8 * self.N_POP_CATS))
+        # aggregates, kept up to date by every mutation
+        self.totals = self.layout.aggregate(self.population_groups)
+        self.set_total_population(1000)
+
+    def get_total(self):
+        return self.total_population
+
+    def set_rng(self, rng):
+        self.rng = rng
+
+    def set_allocation(self, allocation):
+        if allocation not in INFECTION_ALLOCATIONS:
+            raise ValueError("unknown infection allocation: {}".format(allocation))
+        self.allocation = allocation
+
+    def set_groups(self, groups):
+        self.population_groups = array('q', groups)
+        self.totals = self.layout.aggregate(self.population_groups)
+
+    def get_totals(self):
+        return self.totals
+
+    def get_taxable_population(self):
+        return self.totals["taxable"]
+
+    def get_relief_population(self):
+        return self.totals["relief"]
+
+    def get_infected_population(self):
+        return self.totals["infected"]
+
+    def get_vaccinated_population(self):
+        return self.totals["vaccinated"]
+
+    def get_immune_population(self):
+        return self.totals["immune"]
+
+    def move(self, src, dst, amount):
+        # move people between groups, aggregates are updated in place
+        if amount:
+            self.population_groups[src] -= amount
+            self.population_groups[dst] += amount
+            for name, sign in self.layout.move_deltas[src][dst]:
+                self.totals[name] += sign * amount
+
+    def set_total_population(self, new_total):
+        # reset with all healthy not vaccinated
+        self.total_population = int(new_total)
+        groups = [0 for i in range(self.N_POP_CATS)]
+        working = int(new_total * WORKING_PERCENT)
+        not_working = new_total - working
+        groups[0] = working
+        groups[1] = not_working
+        self.set_groups(groups)
+
+    def pass_week(self):
+        # shift infected and vaccinated in one gather over the shift table
+        old = self.population_groups
+        self.population_groups = array('q', [sum([old[src] for src in sources])
+                                             for sources in self.layout.shift_sources])
+        for name, terms in self.layout.shift_deltas:
+            self.totals[name] += sum([sign * old[src] for src, sign in terms])
+
+    def vaccinate(self, quota):
+        # -_-'
+        vaccinable_groups = self.population_groups[:2]
+        vaccinable = sum(vaccinable_groups)
+
+        quota = min(quota, vaccinable)
+
+        d = self.rng.random()
+        g1 = int(quota * d)
+        g2 = quota - g1
+        if g1 > vaccinable_groups[0]:
+            g2 += g1 - vaccinable_groups[0]
+            g1 = vaccinable_groups[0]
+        elif g2 > vaccinable_groups[1]:
+            g1 += g2 - vaccinable_groups[1]
+            g2 = vaccinable_groups[1]
+
+        self.move(0, 2, g1)
+        self.move(1, 3, g2)
+
+        return quota
+
+    def get_vaccinable_population(self):
+        return sum(self.population_groups[:2])
+
+    def infect(self, quota):
+        infectable_groups = self.population_groups[:6]
+        infectable = sum(infectable_groups)
+
+        quota = min(quota, infectable)
+
+        # decide who to infect
+        if self.allocation == "capped":
+            groups = capped_split(quota, infectable_groups,
+                                  [self.rng.random() for i in range(CAPPED_SPLIT_DRAWS)])
+        else:
+            groups = retry_split(quota, infectable_groups, get_destribution(6, self.rng), self.rng)
+
+        # decide infection duration
+        for i in range(6):
+            cur_groups = [int(INFECTION_DURATION[j] * groups[i]) for j in range(3)]
+            cur_groups[0] += groups[i] - sum(cur_groups)
+            for j in range(3):
+                self.move(i, i+(j+1)*8, cur_groups[j])
+
+        return quota
+
+    def standard_process(self, cur_month):
+        infected = self.get_infected_population() + self.imported_infected
+        total = self.get_total()
+        vaccinated = self.get_vaccinated_population()
+        new_infected = infected * ((total - vaccinated) / total)
+        new_infected *= self.parent_city.transport_density
+        new_infected *= CITY_SIZE_INFECT_COEFFICIENTS[self.parent_city.size_type]
+        new_infected *= 1 + ((total / CITY_MAX_POPULATION) ** 2) / 10
+        new_infected *= MONTH_INFECTION_COEFFICIENTS[cur_month]
+        new_infected = int(new_infected * (self.rng.random() / 4 + (7 / 8)))
+
+        #print(new_infected)
+
+        # test
+        # new_infected = int(self.total_population * random() / 3)
+
+        self.infect(new_infected)
+
+    def copy(self, parent_city):
+        population = copy(self)
+        population.parent_city = parent_city
+        population.population_groups = array('q', self.population_groups)
+        population.totals = dict(self.totals)
+        population.rng = self.rng.copy()
+        return population
+
+    def __str__(self):
+        return ((("{} " * 8) + '\n') * 4).format(*self.population_groups)
+
+
+class City(object):
+    __slots__ = ("parent_country", "city_id", "population", "size_type", "r", "transport_density", "is_epidemic",
+                 "vaccination_quota", "norm_color", "infect_color", "epid_color", "alpha", "pos")
+
+    def __init__(self):
+        self.parent_country = None
+        # stable id given by the country, None until the city is added
+        self.city_id = None
+
+        self.population = Population(self)
+        self.size_type = 0
+        self.r = 10
+
+        self.transport_density = 1.0
+        self.is_epidemic = False
+
+        self.vaccination_quota = 0
+
+        # colors are (r, g, b) tuples, the gui turns them into brushes; the
+        # defaults are shared by all cities
+        self.norm_color = CITY_NORMAL_COLOR
+        self.infect_color = CITY_INFECTED_COLOR
+        self.epid_color = CITY_EPIDEMIC_COLOR
+
+        self.alpha = 255
+
+        self.pos = (0.0, 0.0)
+
+    def copy(self):
+        # copy not attached to any country
+        city = copy(self)
+        city.parent_country = None
+        city.city_id = None
+        city.population = self.population.copy(city)
+        return city
+
+    def update_size(self):
+        self.size_type = 0
+        pop = self.population.get_total()
+        for border in CITY_SIZE_POPULATION:
+            if pop >= border:
+                self.size_type += 1
+            else:
+                break
+        self.r = CITY_SIZES[self.size_type]
+
+    def get_radius(self):
+        return self.r
+
+    def get_infected_radius(self):
+        return self.r * ((self.get_infected() / self.get_population()) ** 0.7)
+
+
+    def set_transport_density(self, value):
+        self.transport_density = float(value)
+
+    def set_pos(self, value):
+        x, y = value
+        old_pos = self.pos
+        self.pos = (float(x), float(y))
+        if self.parent_country is not None:
+            self.parent_country.move_city(self, old_pos)
+
+    def set_population(self, value):
+        self.population.set_total_population(int(value))
+        self.update_size()
+        self.update_epidemic()
+        self.changed()
+
+    def set_alpha(self, value):
+        self.alpha = int(value)
+
+    def set_parent(self, country):
+        self.parent_country = country
+
+    def changed(self):
+        # population edited outside of a time step
+        if self.parent_country is not None:
+            self.parent_country.totals = None
+
+    def get_population(self):
+        return self.population.get_total()
+
+    def get_infected(self):
+        return self.population.get_infected_population()
+
+    def get_vaccinated(self):
+        return self.population.get_vaccinated_population()
+
+    def get_immune(self):
+        return self.population.get_immune_population()
+
+
+    def set_vaccination_quota(self, quota):
+        self.vaccination_quota = quota
+
+    def vaccinate(self, quota):
+        vaccinated = self.population.vaccinate(quota)
+        self.changed()
+        return vaccinated
+
+    def infect(self, quota):
+        infected = self.population.infect(quota)
+        self.update_epidemic()
+        self.changed()
+        return infected
+
+    def update_epidemic(self):
+        infected = self.population.get_infected_population()
+        self.is_epidemic = infected >= self.population.get_total() * EPIDEMIC_BORDER
+
+    def get_vaccine_demand(self):
+        # vaccines the quota asks for this week, after pass_week
+        return min(self.vaccination_quota, self.population.get_vaccinable_population())
+
+    def process_time_step(self, cur_month, infection_update_func, funds_quota):
+        # must return funds balance delta from current city
+
+        self.population.pass_week()
+
+        return self.finish_time_step(cur_month, infection_update_func, min(funds_quota, self.vaccination_quota))
+
+    def finish_time_step(self, cur_month, infection_update_func, vaccines):
+        # rest of the week after pass_week, given the vaccines it may use
+        vaccinated = self.vaccinate(vaccines)
+
+        infection_update_func(self.population, cur_month)
+
+        delta_funds = self.parent_country.tax_per_soul * self.population.get_taxable_population()
+        delta_funds -= self.parent_country.vaccination_cost * vaccinated
+        delta_funds -= self.parent_country.relief_cost * self.population.get_relief_population()
+
+        self.update_epidemic()
+
+        #print(self.population)
+
+        return delta_funds
+
+
+class Country(object):
+    def __init__(self):
+        # cities are stored densely, removal swaps the last city into the
+        # freed slot; city ids never change and map to the current slot
+        self.cities = []
+        self.slots = {}
+        self.next_city_id = 0
+        # city positions, for hit tests and overlap checks
+        self.index = SpatialGrid()
+
+        self.vaccination_cost = 0.0
+        self.relief_cost = 0.0
+        self.current_funds = 0.0
+        self.tax_per_soul = 0.0
+
+        self.infection_allocation = Population.DEFAULT_ALLOCATION
+        self.budget_policy = "sequential"
+
+        # random streams, one per city id, when a seed is set
+        self.seed = None
+        self.stream_root = None
+
+        # (cutoff, strength) of the inter-city coupling, None for isolated
+        # cities; the matrix is rebuilt when cities are added, removed or moved
+        self.mobility = None
+        self.mobility_matrix = None
+
+        # country totals, counted after every time step and on demand after
+        # an edit; None when out of date
+        self.totals = None
+
+    def add_city(self, city, city_id=None):
+        # adds a copy of city and returns it; city_id is for restoring saved
+        # cities, new cities get the next free id
+        if city_id is None:
+            city_id = self.next_city_id
+        elif city_id in self.slots:
+            raise ValueError("city id {} is taken".format(city_id))
+        city = city.copy()
+        city.set_parent(self)
+        city.city_id = city_id
+        self.next_city_id = max(self.next_city_id, city_id + 1)
+        self.slots[city.city_id] = len(self.cities)
+        self.cities.append(city)
+
+        city.population.set_allocation(self.infection_allocation)
+        self.assign_stream(city)
+        self.index.insert(city)
+        self.mobility_matrix = None
+        self.totals = None
+        return city
+
+    def get_city(self, city_id):
+        slot = self.slots.get(city_id)
+        return self.cities[slot] if slot is not None else None
+
+    def set_seed(self, seed):
+        # None goes back to the shared unseeded generator
+        self.seed = seed
+        self.stream_root = seed_root(seed) if seed is not None else None
+        for city in self.cities:
+            self.assign_stream(city)
+
+    def assign_stream(self, city):
+        if self.seed is None:
+            city.population.set_rng(GLOBAL_STREAM)
+        else:
+            city.population.set_rng(CityStream(stream_key(self.stream_root, city.city_id)))
+
+    def remove_city(self, city):
+        # city is a City or a city id
+        city_id = city.city_id if type(city) == City else int(city)
+        slot = self.slots.pop(city_id)
+        removed = self.cities[slot]
+        last = self.cities.pop()
+        if last is not removed:
+            self.cities[slot] = last
+            self.slots[last.city_id] = slot
+        self.index.remove(removed)
+        self.mobility_matrix = None
+        self.totals = None
+
+    def snapshot(self):
+        snapshot = CountrySnapshot()
+        snapshot.economics = (self.vaccination_cost, self.relief_cost, self.current_funds, self.tax_per_soul)
+        snapshot.city_ids = array('q', [city.city_id for city in self.cities])
+        for city in self.cities:
+            population = city.population
+            snapshot.groups.extend(population.population_groups)
+            snapshot.totals.extend(population.totals.values())
+            snapshot.population.append(population.total_population)
+            snapshot.quotas.append(city.vaccination_quota)
+            snapshot.densities.append(city.transport_density)
+            snapshot.epidemic.append(city.is_epidemic)
+        if self.seed is not None:
+            streams = [city.population.rng for city in self.cities]
+            snapshot.stream_keys = array('Q', [stream.key for stream in streams])
+            snapshot.stream_counters = array('q', [stream.counter for stream in streams])
+        return snapshot
+
+    def restore(self, snapshot):
+        # back to the state of snapshot, in place; the set of cities must not
+        # have changed since it was taken
+        if snapshot.city_ids != array('q', [city.city_id for city in self.cities]):
+            raise ValueError("snapshot was taken from a different set of cities")
+        self.vaccination_cost, self.relief_cost, self.current_funds, self.tax_per_soul = snapshot.economics
+
+        n, names = Population.N_POP_CATS, PopulationLayout.AGGREGATES
+        groups, totals = snapshot.groups, snapshot.totals.tolist()
+        if snapshot.stream_keys is not None:
+            streams = zip(snapshot.stream_keys, snapshot.stream_counters)
+        else:
+            streams = None
+        for slot, city in enumerate(self.cities):
+            population = city.population
+            population.population_groups = groups[slot * n:(slot + 1) * n]
+            population.totals = dict(zip(names, totals[slot * len(names):(slot + 1) * len(names)]))
+            if population.total_population != snapshot.population[slot]:
+                population.total_population = snapshot.population[slot]
+                city.update_size()
+            city.vaccination_quota = snapshot.quotas[slot]
+            city.transport_density = snapshot.densities[slot]
+            city.is_epidemic = bool(snapshot.epidemic[slot])
+            if streams is not None:
+                population.rng = CityStream(*next(streams))
+        self.totals = None
+
+    def move_city(self, city, old_pos):
+        self.index.move(city, old_pos)
+        self.mobility_matrix = None
+
+    def rebuild_index(self):
+        # after self.cities was changed directly
+        self.slots = {city.city_id: slot for slot, city in enumerate(self.cities)}
+        self.index.clear()
+        for city in self.cities:
+            self.index.insert(city)
+        self.mobility_matrix = None
+
+    def set_mobility(self, cutoff=MOBILITY_CUTOFF, strength=MOBILITY_STRENGTH):
+        # cutoff None turns the coupling off
+        self.mobility = (cutoff, strength) if cutoff is not None else None
+        self.mobility_matrix = None
+        if self.mobility is None:
+            for city in self.cities:
+                city.population.imported_infected = 0
+
+    def get_mobility_matrix(self):
+        # mobility.MobilityMatrix over self.cities, None without coupling
+        if self.mobility is None:
+            return None
+        if self.mobility_matrix is None:
+            from mobility import MobilityMatrix
+            self.mobility_matrix = MobilityMatrix.from_country(self, *self.mobility)
+        return self.mobility_matrix
+
+    def update_imported_infected(self):
+        # infection pressure from the other cities, from the state at the
+        # start of the week so it doesn't depend on the order of the cities
+        matrix = self.get_mobility_matrix()
+        if matrix is None:
+            return
+        imported = matrix.get_imported([city.get_infected() for city in self.cities],
+                                       [city.get_population() for city in self.cities])
+        for city, value in zip(self.cities, imported.tolist()):
+            city.population.imported_infected = value
+
+    def check_vicinity(self, pos, r):
+        return self.index.is_free(pos, r)
+
+    def find_city(self, pos):
+        return self.index.find(pos)
+
+    def process_time_step(self, cur_month, infection_update_func):
+        self.update_imported_infected()
+        if self.budget_policy == "sequential":
+            for city in self.cities:
+                self.current_funds += city.process_time_step(cur_month, infection_update_func,
+                                      max(0, int(self.current_funds / self.vaccination_cost)))
+            self.update_totals()
+            return
+
+        # every city gets its share of the funds of the start of the week,
+        # so the cities don't depend on each other or on their order
+        for city in self.cities:
+            city.population.pass_week()
+        demands = [city.get_vaccine_demand() for city in self.cities]
+        if self.vaccination_cost > 0:
+            budget = max(0, int(self.current_funds / self.vaccination_cost))
+        else:
+            budget = sum(demands)
+        rates = None
+        if self.budget_policy == "priority":
+            rates = [city.get_infected() / city.get_population() if city.get_population() else 0.0
+                     for city in self.cities]
+        vaccines = allocate_budget(self.budget_policy, budget, demands,
+                                   [city.city_id for city in self.cities], rates)
+        self.current_funds += fsum([city.finish_time_step(cur_month, infection_update_func, quota)
+                                    for city, quota in zip(self.cities, vaccines)])
+        self.update_totals()
+
+
+    def update_totals(self):
+        # one pass over the cities for all the totals
+        population = infected = vaccinated = immune = 0
+        for city in self.cities:
+            population += city.population.total_population
+            totals = city.population.totals
+            infected += totals["infected"]
+            vaccinated += totals["vaccinated"]
+            immune += totals["immune"]
+        self.totals = {"population": population, "infected": infected,
+                       "vaccinated": vaccinated, "immune": immune}
+
+    def get_totals(self):
+        if self.totals is None:
+            self.update_totals()
+        return self.totals
+
+    def get_total_population(self):
+        return self.get_totals()["population"]
+
+    def get_total_infected(self):
+        return self.get_totals()["infected"]
+
+    def get_total_vaccinated(self):
+        return self.get_totals()["vaccinated"]
+
+    def get_total_immune(self):
+        return self.get_totals()["immune"]
+
+
+    def set_budget_policy(self, policy):
+        if policy not in BUDGET_POLICIES:
+            raise ValueError("unknown budget policy: {}".format(policy))
+        self.budget_policy = policy
+
+    def set_infection_allocation(self, allocation):
+        for city in self.cities:
+            city.population.set_allocation(allocation)
+        self.infection_allocation = allocation
+
+    def get_vaccination_cost(self):
+        return self.vaccination_cost
+
+    def set_vaccination_cost(self, cost):
+        self.vaccination_cost = cost;
+
+    def get_relief_cost(self):
+        return self.relief_cost
+
+    def set_relief_cost(self, cost):
+        self.relief_cost = cost;
+
+    def get_current_funds(self):
+        return self.current_funds
+
+    def set_current_funds(self, funds):
+        self.current_funds = funds;
+
+    def get_tax(self):
+        return self.tax_per_soul
+
+    def set_tax(self, tax):
+        self.tax_per_soul = tax;
+
+
+class CountrySnapshot(object):
+    # numeric state of a country, per city values in flat arrays in the
+    # order of country.cities
+    def __init__(self):
+        self.economics = None
+        self.city_ids = array('q')
+        self.groups = array('q')
+        self.totals = array('q')
+        self.population = array('q')
+        self.quotas = array('q')
+        self.densities = array('d')
+        self.epidemic = array('b')
+        self.stream_keys = None
+        self.stream_counters = None
+
+    # per city arrays and their number of values per city
+    ROWS = (("groups", Population.N_POP_CATS), ("totals", len(PopulationLayout.AGGREGATES)),
+            ("population", 1), ("quotas", 1), ("densities", 1), ("epidemic", 1))
+
+    def get_size(self):
+        # bytes held by the arrays
+        arrays = [self.city_ids, self.groups, self.totals, self.population, self.quotas, self.densities,
+                  self.epidemic, self.stream_keys, self.stream_counters]
+        return sum(len(a) * a.itemsize for a in arrays if a is not None)
+
+    def diff(self, base):
+        # delta from base to this snapshot, both taken from the same cities
+        delta = CountryDelta()
+        delta.economics = self.economics
+        n = Population.N_POP_CATS
+        groups, base_groups = self.groups, base.groups
+        for slot in range(len(self.city_ids)):
+            if (groups[slot * n:(slot + 1) * n] != base_groups[slot * n:(slot + 1) * n] or
+                    self.quotas[slot] != base.quotas[slot] or
+                    self.densities[slot] != base.densities[slot] or
+                    self.epidemic[slot] != base.epidemic[slot]):
+                delta.slots.append(slot)
+                for name, width in self.ROWS:
+                    getattr(delta, name).extend(getattr(self, name)[slot * width:(slot + 1) * width])
+        if self.stream_counters != base.stream_counters:
+            delta.stream_counters = self.stream_counters
+        return delta
+
+    def patch(self, delta):
+        # new snapshot: this one with delta applied
+        snapshot = CountrySnapshot()
+        snapshot.economics = delta.economics
+        snapshot.city_ids = self.city_ids
+        snapshot.stream_keys = self.stream_keys
+        snapshot.stream_counters = self.stream_counters
+        if delta.stream_counters is not None:
+            snapshot.stream_counters = delta.stream_counters
+        for name, width in self.ROWS:
+            values, changed = array(getattr(self, name).typecode, getattr(self, name)), getattr(delta, name)
+            for k, slot in enumerate(delta.slots):
+                values[slot * width:(slot + 1) * width] = changed[k * width:(k + 1) * width]
+            setattr(snapshot, name, values)
+        return snapshot
+
+
+class CountryDelta(object):
+    # rows of the cities that changed between two snapshots, stream
+    # counters whole since every city draws every week
+    def __init__(self):
+        self.economics = None
+        self.slots = array('q')
+        self.groups = array('q')
+        self.totals = array('q')
+        self.population = array('q')
+        self.quotas = array('q')
+        self.densities = array('d')
+        self.epidemic = array('b')
+        self.stream_counters = None
+
+    def get_size(self):
+        arrays = [self.slots, self.groups, self.totals, self.population, self.quotas, self.densities,
+                  self.epidemic, self.stream_counters]
+        return sum(len(a) * a.itemsize for a in arrays if a is not None)
+
+
+class SimulationClock(object):
+    def __init__(self):
+        self.start_time = DEFAULT_START_DATE
+        self.time = self.start_time
+        self.duration = 6 # months
+        self.finish_time = self.start_time + timedelta(days=self.duration * MONTH_DURATION)
+
+    def set_start_month(self, month):
+        # month is 1-based
+        self.start_time = date(DEFAULT_START_DATE.year, month, DEFAULT_START_DATE.day)
+        self.time = self.start_time
+
+    def set_duration(self, duration):
+        self.duration = duration
+
+    def start(self):
+        self.finish_time = self.start_time + timedelta(days=self.duration * MONTH_DURATION)
+
+    def reset(self):
+        self.time = self.start_time
+
+    def get_n_weeks(self):
+        # number of steps from start to finish
+        days = self.duration * MONTH_DURATION
+        return -(-days // SIMULATION_STEP.days)
+
+    def tick(self):
+        self.time += SIMULATION_STEP
+
+    def get_month(self):
+        return self.time.month
+
+    def get_week(self):
+        # number of steps made since start
+        return (self.time - self.start_time).days // SIMULATION_STEP.days
+
+    def is_over(self):
+        return self.time >= self.finish_time
+
+
+class Simulation(object):
+    # finish states reported by step()
+    FLAT_BROKE = "Simulation finished: flat-broke"
+    TIME_IS_UP = "Simulation finished: time is up"
+
+    def __init__(self, country, infection_update_func=Population.standard_process):
+        self.country = country
+        self.infection_update_func = infection_update_func
+        self.clock = SimulationClock()
+
+        self.preparing = True
+        self.finished = False
+
+        self.bckp = None
+        # optional timeline.Timeline and recorder.TrajectoryRecorder,
+        # both see every week
+        self.timeline = None
+        self.recorder = None
+
+    def set_infection_func(self, func):
+        self.infection_update_func = func
+
+    def set_seed(self, seed):
+        self.country.set_seed(seed)
+
+    def set_timeline(self, timeline):
+        self.timeline = timeline
+
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+
+    def set_country(self, country):
+        # only while preparing, the backup is taken on init
+        self.country = country
+        self.bckp = None
+
+    def init_simulation(self):
+        self.bckp = self.snapshot()
+        self.clock.start()
+        self.preparing = False
+        if self.timeline is not None:
+            self.timeline.clear()
+            self.timeline.record(self)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def step(self):
+        # advance one week, returns finish state or None if still running
+        if self.preparing:
+            self.init_simulation()
+
+        state = None
+        self.country.process_time_step(self.clock.get_month(), self.infection_update_func)
+        if self.country.current_funds < 0:
+            state = self.FLAT_BROKE
+        self.clock.tick()
+        if self.clock.is_over():
+            state = self.TIME_IS_UP
+
+        if state is not None:
+            self.finished = True
+        if self.timeline is not None:
+            self.timeline.record(self)
+        if self.recorder is not None and not (self.timeline is not None and self.timeline.replaying):
+            self.recorder.record(self)
+        return state
+
+    def run(self, weeks=None):
+        # step until finished (or for given number of weeks), returns last state
+        state = None
+        while not self.finished and (weeks is None or weeks > 0):
+            state = self.step()
+            if weeks is not None:
+                weeks -= 1
+        return state
+
+    def snapshot(self):
+        return (self.country.snapshot(), self.clock.time, self.preparing, self.finished)
+
+    def restore(self, snapshot):
+        country_snapshot, self.clock.time, self.preparing, self.finished = snapshot
+        self.country.restore(country_snapshot)
+
+    def reset(self):
+        self.preparing = True
+        self.finished = False
+        self.clock.reset()
+        if self.bckp is not None:
+            self.restore(self.bckp)
+        if self.timeline is not None:
+            self.timeline.clear()
@@ -0,0 +1,145 @@
+# Monte Carlo ensembles: many seeded replicates of one scenario are run on a
+# process pool and folded into per-week quantile estimates as they finish,
+# without keeping the individual trajectories.
+
+from concurrent.futures import wait, FIRST_COMPLETED
+from copy import deepcopy
+from itertools import islice
+import os
+
+import numpy as np
+
+from engine import Population, SimulationClock, Simulation
+from batch import BatchCountry
+from pool import scenario_pool, run_task
+
+
+# per-week values recorded for every replicate
+ENSEMBLE_METRICS = ("infected", "vaccinated", "funds")
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+class P2Quantile(object):
+    # P-square streaming estimate of one quantile for a whole array of
+    # independent series (Jain & Chlamtac), five markers per element
+    def __init__(self, q, shape):
+        self.q = q
+        self.count = 0
+        self.heights = np.zeros(shape + (5,))
+        self.positions = np.tile(np.arange(1.0, 6.0), shape + (1,))
+        self.desired = np.tile(np.array([1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5.0]), shape + (1,))
+        self.increments = np.array([0, q / 2, q, (1 + q) / 2, 1])
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.count < 5:
+            self.heights[..., self.count] = x
+            self.count += 1
+            if self.count == 5:
+                self.heights.sort(axis=-1)
+            return
+        self.count += 1
+
+        h, n = self.heights, self.positions
+        h[..., 0] = np.minimum(h[..., 0], x)
+        h[..., 4] = np.maximum(h[..., 4], x)
+        # markers above the new value move one position up
+        n[..., 1:] += x[..., None] < h[..., 1:]
+        n[..., 4] = self.count
+        self.desired += self.increments
+
+        for i in range(1, 4):
+            d = self.desired[..., i] - n[..., i]
+            up = (d >= 1) & (n[..., i + 1] - n[..., i] > 1)
+            down = (d <= -1) & (n[..., i - 1] - n[..., i] < -1)
+            move = up | down
+            if not move.any():
+                continue
+            d = np.where(up, 1.0, -1.0)
+            hm, hi, hp = h[..., i - 1], h[..., i], h[..., i + 1]
+            nm, ni, np_ = n[..., i - 1], n[..., i], n[..., i + 1]
+            parabolic = hi + d / (np_ - nm) * ((ni - nm + d) * (hp - hi) / (np_ - ni) +
+                                               (np_ - ni - d) * (hi - hm) / (ni - nm))
+            neighbour = np.where(up, hp, hm)
+            neighbour_pos = np.where(up, np_, nm)
+            linear = hi + d * (neighbour - hi) / (neighbour_pos - ni)
+            new = np.where((hm < parabolic) & (parabolic < hp), parabolic, linear)
+            h[..., i] = np.where(move, new, hi)
+            n[..., i] = np.where(move, ni + d, ni)
+
+    def value(self):
+        if self.count >= 5:
+            return self.heights[..., 2].copy()
+        # too few values for the markers, exact quantile of what was seen
+        seen = np.sort(self.heights[..., :self.count], axis=-1)
+        return seen[..., int(round(self.q * (self.count - 1)))]
+
+
+class EnsembleSummary(object):
+    def __init__(self, n_weeks, quantiles):
+        self.n_replicates = 0
+        self.n_broke = 0
+        self.quantiles = tuple(quantiles)
+        self.estimators = [P2Quantile(q, (n_weeks, len(ENSEMBLE_METRICS))) for q in self.quantiles]
+
+    def add(self, trajectory, broke):
+        self.n_replicates += 1
+        self.n_broke += bool(broke)
+        for estimator in self.estimators:
+            estimator.add(trajectory)
+
+    def get(self, metric):
+        # (n_weeks, n_quantiles) array of the current estimates
+        k = ENSEMBLE_METRICS.index(metric)
+        return np.stack([estimator.value()[:, k] for estimator in self.estimators], axis=1)
+
+
+def run_replicate(country, clock, seed, infection_update_func=Population.standard_process, use_batch=True):
+    # one seeded run, returns (n_weeks, len(ENSEMBLE_METRICS)) values and
+    # whether the country went broke; weeks after the end repeat the last state
+    if use_batch:
+        state = BatchCountry.from_country(country, seed)
+    else:
+        state = deepcopy(country)
+        state.set_seed(seed)
+    simulation = Simulation(state, infection_update_func)
+    simulation.clock = deepcopy(clock)
+
+    trajectory = np.zeros((clock.get_n_weeks(), len(ENSEMBLE_METRICS)))
+    week = 0
+    result = None
+    while not simulation.finished and week < len(trajectory):
+        result = simulation.step()
+        trajectory[week] = (state.get_total_infected(), state.get_total_vaccinated(), state.current_funds)
+        week += 1
+    trajectory[week:] = trajectory[week - 1]
+    return trajectory, result == Simulation.FLAT_BROKE
+
+def _run_worker_replicate(scenario, seed):
+    country, clock, infection_update_func, use_batch = scenario
+    return run_replicate(country, clock, seed, infection_update_func, use_batch)
+
+
+def run_ensemble(country, seeds, clock=None, quantiles=DEFAULT_QUANTILES, max_workers=None,
+                 infection_update_func=Population.standard_process, use_batch=True):
+    # generator, yields the updated EnsembleSummary each time a replicate
+    # finishes; at most two replicates per worker are queued or finished and
+    # not folded in yet, so seeds may be an endless iterator
+    if clock is None:
+        clock = SimulationClock()
+    summary = EnsembleSummary(clock.get_n_weeks(), quantiles)
+    seeds = iter(seeds)
+    window = 2 * (max_workers or os.cpu_count() or 1)
+    with scenario_pool((country, clock, infection_update_func, use_batch), max_workers) as pool:
+        pending = {pool.submit(run_task, _run_worker_replicate, seed) for seed in islice(seeds, window)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                # popped, so the trajectory goes once it is folded in
+                trajectory, broke = done.pop().result()
+                summary.add(trajectory, broke)
+                trajectory = None
+                for seed in islice(seeds, 1):
+                    pending.add(pool.submit(run_task, _run_worker_replicate, seed))
+                yield summary
@@ -5,6 +5,7 @@ import sys
 
 from classes import *
 from constants import *
+from scenario import load_scenario
 
 # returns function from integer which shows all widgets on selected page
 # and hides all widgets on other pages
@@ -73,7 +74,7 @@ country = Country()
 
 cur = City()
 for i in range(6,7):
-    cur.pos = QtCore.QPointF(60 + 40 * i, 250)
+    cur.set_pos((60 + 40 * i, 250))
     cur.set_population(10 ** i)
     cur.set_vaccination_quota(10 ** (i - 2))
     cur.population.infect(1 * 10 ** (i - 2))
@@ -87,6 +88,12 @@ country.relief_cost = 10.0
 country.current_funds = 10000000.0
 country.tax_per_soul = 1.0
 
+# a scenario file given on the command line replaces the setup above
+scenario = None
+if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+    scenario = load_scenario(sys.argv[1])
+    country = scenario.to_country()
+
 #########################
 
 def test_clock_madness(self):
@@ -96,18 +103,19 @@ def test_clock_madness(self):
     r = randrange(0, 255)
     g = randrange(0, 255)
     b = randrange(0, 255)
-    city.norm_color = QtGui.QColor(r, g, b)
+    city.norm_color = (r, g, b)
     city.r = CITY_SIZES[randrange(2, len(CITY_SIZES))]
     x = randrange(15, COUNTRY_SIZE[0] - 30)
     y = randrange(15, COUNTRY_SIZE[1] - 30)
-    city.pos = QPointF(x, y)
+    city.set_pos((x, y))
 
     Max = 100
     Speed = 150
     if (randrange(1000) == 0):
         country.add_city(City())
-        country.cities = country.cities[:Max]
-    simulator.clock.setInterval(len(country.cities) / Max * Speed)
+        while len(country.cities) > Max:
+            country.remove_city(country.cities[-1])
+    simulator.worker.timer.setInterval(int(len(country.cities) / Max * Speed))
 
 #########################
 
@@ -135,7 +143,7 @@ simulator.set_infection_func(Population.standard_process)
 # test
 # simulator.set_infection_func(test_clock_madness)
 
-simulator.new_city.set_pos(QtCore.QPointF(200, 100))
+simulator.new_city.set_pos((200, 100))
 simulator.new_city.set_population(10 ** 3)
 
 ###########################################
@@ -255,6 +263,27 @@ time_label = QtWidgets.QLabel(tab_global)
 time_label.setGeometry(300, 400, 300, 40)
 time_label.setText("Elapsed time: 0")
 
+timeline_slider = QtWidgets.QSlider(QtCore.Qt.Horizontal, tab_global)
+timeline_slider.setGeometry(300, 200, 270, 20)
+timeline_slider.setRange(0, 0)
+timeline_slider.setToolTip("Go back to a past week")
+timeline_slider.valueChanged.connect(simulator.seek_week)
+
+def set_timeline_slider(week, last_week):
+    timeline_slider.blockSignals(True)
+    timeline_slider.setRange(0, max(last_week, 0))
+    timeline_slider.setValue(week)
+    timeline_slider.blockSignals(False)
+
+simulator.TimelineChanged.connect(set_timeline_slider)
+
+save_scenario_button = QtWidgets.QPushButton("Save", tab_global)
+save_scenario_button.setGeometry(400, 5, 80, 30)
+save_scenario_button.clicked.connect(simulator.save_scenario)
+
+load_scenario_button = QtWidgets.QPushButton("Load", tab_global)
+load_scenario_button.setGeometry(490, 5, 80, 30)
+
 simulation_reset_button = QtWidgets.QPushButton("Reset simulation", tab_global)
 simulation_reset_button.setGeometry(400, 500, 170, 40)
 simulation_reset_button.clicked.connect(simulator.reset_simulation)
@@ -288,7 +317,12 @@ QtCore.QObject.connect(simulation_start_input, QtCore.SIGNAL("currentIndexChange
                        simulator.set_start_month)
 
 
+fast_forward_button = QtWidgets.QPushButton("Run to end", tab_global)
+fast_forward_button.setGeometry(400, 466, 170, 30)
+fast_forward_button.clicked.connect(simulator.fast_forward_simulation)
+
 simulator.set_clock_control_buttons([start_button, pause_button, step_button, simulation_reset_button])
+simulator.set_fast_forward_button(fast_forward_button)
 
 
 simulation_duration_label = QtWidgets.QLabel(tab_global)
@@ -310,6 +344,17 @@ simulation_duration_input.editingFinished.connect(change_state_func(simulator.se
                          simulation_duration_input_stat_label)))
 
 
+def load_scenario_clicked():
+    if simulator.load_scenario():
+        simulation_start_input.setCurrentIndex(simulator.simulation.clock.start_time.month - 1)
+
+load_scenario_button.clicked.connect(load_scenario_clicked)
+
+if scenario is not None:
+    scenario.apply_clock(simulator.simulation.clock)
+    simulation_start_input.setCurrentIndex(scenario.start_month - 1)
+
+
 simulator.set_param_labels([cur_funds_label, tax_label, vaccination_label, relief_label, speed_label, time_label, 
                             total_population_label, total_infected_label, total_vaccinated_label, total_immune_label,
                             simulation_duration_label])
@@ -433,6 +478,10 @@ new_city_transport_density_button.pressed.connect(change_state_func(simulator.se
 simulator.set_new_city_labels([new_city_pop_label, new_city_infected_label, new_city_quota_label, 
                                new_city_vaccinated_label, new_city_transport_density_label])
 
+optimize_quotas_button = QtWidgets.QPushButton("Pick vaccination quotas", tab_create_city)
+optimize_quotas_button.setGeometry(10, 330, 300, 40)
+optimize_quotas_button.clicked.connect(simulator.optimize_quotas)
+
 control_tabs.addTab(tab_create_city, "Create City")
 ##########################################################
 tab_manage_city = QtWidgets.QWidget()
@@ -574,7 +623,8 @@ simulator.SelectedCity.connect(show_function([[idle_label], elems]))
 control_tabs.addTab(tab_manage_city, "Manage City")
 ###########################################
 simulator.set_preparation_only_elems([simulation_start_input, city_pop_input, city_pop_button, 
-                                      tab_create_city, cur_funds_input, delete_city_button])
+                                      tab_create_city, cur_funds_input, delete_city_button,
+                                      load_scenario_button])
 
 
 QtCore.QObject.connect(control_tabs, QtCore.SIGNAL("currentChanged(int)"),
@@ -594,5 +644,5 @@ app.exec_()
 # DONE: глобальный reset
 # DONE: нельзя добавлять города в течение симуляции
 
-# bonus: добавить автоматический выбор квоты на вакцинацию
-# bonusbonus: сохранение?
+# DONE: bonus: добавить автоматический выбор квоты на вакцинацию
+# DONE: bonusbonus: сохранение?
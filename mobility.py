@@ -0,0 +1,78 @@
+# Coupling between cities: travel mixes the population of cities closer than
+# a cutoff distance. The city x city matrix is kept sparse in coordinate
+# form (only pairs within the cutoff, found through a grid of cutoff-sized
+# cells) and applied each week as one sparse mat-vec with bincount.
+
+import numpy as np
+
+from constants import *
+
+
+def neighbour_pairs(pos, cutoff):
+    # (i, j, distance) of every ordered pair of distinct points closer than cutoff
+    pos = np.asarray(pos, dtype=np.float64).reshape(-1, 2)
+    n = len(pos)
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    cells = np.floor(pos / cutoff).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    width = cells[:, 1].max() + 2
+    keys = cells[:, 0] * width + cells[:, 1]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    rows, cols = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            target = keys + dx * width + dy
+            start = np.searchsorted(sorted_keys, target, side="left")
+            counts = np.searchsorted(sorted_keys, target, side="right") - start
+            total = counts.sum()
+            if total == 0:
+                continue
+            # position of each pair inside its cell run
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows.append(np.repeat(np.arange(n), counts))
+            cols.append(order[np.repeat(start, counts) + within])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    distances = np.hypot(*(pos[rows] - pos[cols]).T)
+    near = (rows != cols) & (distances < cutoff)
+    return rows[near], cols[near], distances[near]
+
+
+class MobilityMatrix(object):
+    # weights[k] is the share of contacts of city rows[k] made with people
+    # of city cols[k], it falls linearly from strength to 0 at the cutoff
+    def __init__(self, n_cities, rows, cols, weights):
+        self.n_cities = n_cities
+        self.rows = rows
+        self.cols = cols
+        self.weights = weights
+
+    @classmethod
+    def from_positions(cls, pos, cutoff=MOBILITY_CUTOFF, strength=MOBILITY_STRENGTH):
+        rows, cols, distances = neighbour_pairs(pos, cutoff)
+        return cls(len(pos), rows, cols, strength * (1 - distances / cutoff))
+
+    @classmethod
+    def from_country(cls, country, cutoff=MOBILITY_CUTOFF, strength=MOBILITY_STRENGTH):
+        # rows in the order of country.cities
+        pos = np.array([city.pos for city in country.cities], dtype=np.float64).reshape(-1, 2)
+        return cls.from_positions(pos, cutoff, strength)
+
+    def get_n_pairs(self):
+        return len(self.rows)
+
+    def apply(self, values):
+        # matrix @ values
+        return np.bincount(self.rows, self.weights * values[self.cols], minlength=self.n_cities)
+
+    def get_imported(self, infected, total):
+        # infected met by every city's population in other cities: the
+        # neighbours' infected fractions weighted by contact share
+        infected = np.asarray(infected, dtype=np.float64)
+        total = np.asarray(total, dtype=np.float64)
+        fractions = np.divide(infected, total, out=np.zeros(len(total)), where=total > 0)
+        return self.apply(fractions) * total
@@ -0,0 +1,120 @@
+# Automatic vaccination quota selection: searches per-city quotas that
+# minimise peak or total infections while the funds never go negative.
+# Candidates run on the batch engine with common random numbers (the same
+# seeds for every candidate) and are abandoned as soon as they can't win.
+
+from copy import deepcopy
+
+import numpy as np
+
+from engine import SimulationClock
+from batch import BatchCountry
+
+
+# "peak": largest weekly number of infected, "total": infected summed over weeks
+OPTIMIZER_OBJECTIVES = ("peak", "total")
+
+
+class QuotaOptimizer(object):
+    def __init__(self, country, clock=None, objective="total", seeds=(0, 1), max_evaluations=200, seed=None):
+        if objective not in OPTIMIZER_OBJECTIVES:
+            raise ValueError("unknown objective: {}".format(objective))
+        self.base = BatchCountry.from_country(country)
+        self.clock = clock if clock is not None else SimulationClock()
+        self.objective = objective
+        self.seeds = tuple(seeds)
+        self.max_evaluations = max_evaluations
+        self.rng = np.random.default_rng(seed)
+
+        self.n_evaluations = 0
+        self.best_quotas = None
+        self.best_value = np.inf
+
+    def evaluate(self, quotas, bound=np.inf):
+        # mean objective over the seeds, inf if the funds go negative or the
+        # candidate is sure to end above bound
+        self.n_evaluations += 1
+        n_weeks = self.clock.get_n_weeks()
+        months = []
+        clock = deepcopy(self.clock)
+        clock.start()
+        for week in range(n_weeks):
+            months.append(clock.get_month())
+            clock.tick()
+
+        limit = bound * len(self.seeds)
+        value = 0.0
+        for seed in self.seeds:
+            batch = deepcopy(self.base)
+            batch.set_seed(seed)
+            batch.vaccination_quota[:] = quotas
+            run_value = 0
+            for month in months:
+                batch.process_time_step(month)
+                if batch.current_funds < 0:
+                    return np.inf
+                infected = batch.get_total_infected()
+                if self.objective == "peak":
+                    run_value = max(run_value, infected)
+                else:
+                    run_value += infected
+                # both objectives only grow, so a losing candidate can stop here
+                if value + run_value > limit:
+                    return np.inf
+            value += run_value
+        return value / len(self.seeds)
+
+    def consider(self, quotas):
+        quotas = np.clip(np.rint(quotas), 0, self.base.total).astype(np.int64)
+        value = self.evaluate(quotas, self.best_value)
+        if value < self.best_value:
+            self.best_value = value
+            self.best_quotas = quotas
+            return True
+        return False
+
+    def optimize(self):
+        # returns the best quotas found (one per city) and their objective
+        self.consider(self.base.vaccination_quota)
+        self.consider(np.zeros(len(self.base.total)))
+
+        # line search along a few directions: quotas proportional to population,
+        # to the current infected and equal for every city
+        directions = [self.base.total.astype(np.float64),
+                      self.base.get_infected_population().astype(np.float64) + 1,
+                      np.ones(len(self.base.total))]
+        for direction in directions:
+            direction = direction / direction.sum()
+            scale = float(self.base.total.sum())
+            for k in range(12):
+                if self.n_evaluations >= self.max_evaluations // 3:
+                    break
+                self.consider(direction * scale)
+                scale /= 2
+
+        # random local search around the best candidate
+        sigma = 0.5
+        while self.n_evaluations < self.max_evaluations and self.best_quotas is not None:
+            candidate = self.best_quotas.astype(np.float64)
+            chosen = self.rng.random(len(candidate)) < 0.3
+            candidate[chosen] *= np.exp(sigma * self.rng.standard_normal(chosen.sum()))
+            candidate[chosen & (candidate < 1)] = self.rng.integers(0, 100, (chosen & (candidate < 1)).sum())
+            if self.consider(candidate):
+                sigma = min(sigma * 1.5, 2.0)
+            else:
+                sigma = max(sigma * 0.9, 0.05)
+
+        return self.best_quotas, self.best_value
+
+
+def apply_quotas(country, quotas):
+    for city, quota in zip(country.cities, quotas):
+        city.set_vaccination_quota(int(quota))
+
+def optimize_quotas(country, clock=None, objective="total", seeds=(0, 1), max_evaluations=200, seed=None):
+    # picks quotas for the country's cities and sets them, returns the objective
+    optimizer = QuotaOptimizer(country, clock, objective, seeds, max_evaluations, seed)
+    quotas, value = optimizer.optimize()
+    if quotas is not None:
+        apply_quotas(country, quotas)
+    return value
@@ -0,0 +1,21 @@
+# Process pools for many runs of one scenario: the scenario goes to every
+# worker process once, through the pool initializer, instead of with every
+# task.
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# scenario of the current worker process, set once by the pool initializer
+_scenario = None
+
+def _init_worker(scenario):
+    global _scenario
+    _scenario = scenario
+
+def run_task(func, arg):
+    # func(scenario, arg) in a worker of a scenario_pool; func must be a
+    # module level function so it can be sent to the worker
+    return func(_scenario, arg)
+
+def scenario_pool(scenario, max_workers=None):
+    return ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(scenario,))
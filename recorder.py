@@ -0,0 +1,156 @@
+# Trajectory recording: the state of every week (the 32 groups and the
+# epidemic flag of every city, the country funds) goes into preallocated
+# chunk buffers, and full chunks are written to .npy files by a background
+# thread. Memory stays at two chunks however long the run is, the chunks
+# can be loaded (or memory-mapped) afterwards.
+
+import os
+import re
+from queue import Queue
+from threading import Thread
+
+import numpy as np
+
+from engine import Population
+from batch import BatchCountry
+
+
+# name, dtype and per city shape of the per city columns
+RECORDER_CITY_COLUMNS = (("groups", np.int64, (Population.N_POP_CATS,)),
+                         ("epidemic", np.bool_, ()))
+# country columns, one value per week
+RECORDER_COUNTRY_COLUMNS = (("week", np.int64), ("funds", np.float64))
+
+CHUNK_FILE = "chunk_{:06d}_{}.npy"
+CHUNK_FILE_RE = re.compile(r"^chunk_\d{6}_\w+\.npy$")
+CITY_IDS_FILE = "city_ids.npy"
+
+
+def get_state(country):
+    # (groups, epidemic) arrays of a Country or a BatchCountry
+    if isinstance(country, BatchCountry):
+        return country.groups, country.is_epidemic
+    cities = country.cities
+    groups = np.array([city.population.population_groups for city in cities], dtype=np.int64)
+    epidemic = np.array([city.is_epidemic for city in cities], dtype=np.bool_)
+    return groups.reshape(len(cities), Population.N_POP_CATS), epidemic
+
+
+class TrajectoryRecorder(object):
+    def __init__(self, directory, chunk_weeks=52):
+        self.directory = directory
+        self.chunk_weeks = chunk_weeks
+        self.n_cities = None
+        self.n_chunks = 0
+        self.n_weeks = 0
+        # buffers being filled and buffers free for the next chunk
+        self.buffers = None
+        self.spare = None
+        self.filled = 0
+
+        self.queue = None
+        self.writer = None
+        self.error = None
+
+    def start(self, country):
+        # called on the first record, the set of cities is fixed from here on
+        os.makedirs(self.directory, exist_ok=True)
+        # chunks of an earlier recording would be read on after this one
+        for name in os.listdir(self.directory):
+            if CHUNK_FILE_RE.match(name) or name == CITY_IDS_FILE:
+                os.remove(os.path.join(self.directory, name))
+        ids = np.array([city.city_id for city in country.cities], dtype=np.int64) \
+            if not isinstance(country, BatchCountry) else country.city_ids.copy()
+        np.save(os.path.join(self.directory, CITY_IDS_FILE), ids)
+        self.n_cities = len(ids)
+        self.buffers = self.allocate()
+        self.spare = Queue()
+        self.spare.put(self.allocate())
+        self.queue = Queue(maxsize=1)
+        self.writer = Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def allocate(self):
+        buffers = {name: np.zeros((self.chunk_weeks, self.n_cities) + shape, dtype=dtype)
+                   for name, dtype, shape in RECORDER_CITY_COLUMNS}
+        buffers.update({name: np.zeros(self.chunk_weeks, dtype=dtype) for name, dtype in RECORDER_COUNTRY_COLUMNS})
+        return buffers
+
+    def record(self, simulation):
+        # called by Simulation after init and after every step
+        country = simulation.country
+        if self.writer is None:
+            self.start(country)
+        if self.error is not None:
+            raise self.error
+        groups, epidemic = get_state(country)
+        if len(groups) != self.n_cities:
+            raise ValueError("cities were added or removed while recording")
+
+        i = self.filled
+        self.buffers["groups"][i] = groups
+        self.buffers["epidemic"][i] = epidemic
+        self.buffers["week"][i] = simulation.clock.get_week()
+        self.buffers["funds"][i] = country.current_funds
+        self.filled += 1
+        self.n_weeks += 1
+        if self.filled == self.chunk_weeks:
+            self.flush()
+
+    def flush(self):
+        # hand the filled part of the buffers to the writer, blocks while it
+        # is still busy with the chunk before
+        if self.filled == 0:
+            return
+        self.queue.put((self.n_chunks, self.buffers, self.filled))
+        self.n_chunks += 1
+        self.buffers = self.spare.get()
+        self.filled = 0
+
+    def write_chunks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            chunk, buffers, filled = item
+            try:
+                if self.error is None:
+                    for name, values in buffers.items():
+                        np.save(os.path.join(self.directory, CHUNK_FILE.format(chunk, name)), values[:filled])
+            except Exception as error:
+                self.error = error
+            self.spare.put(buffers)
+
+    def close(self):
+        # writes the last partial chunk and waits for the writer
+        if self.writer is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_chunks(directory, mmap_mode="r"):
+    # yields {column: array} for every chunk in order, memory-mapped by default
+    names = [name for name, dtype, shape in RECORDER_CITY_COLUMNS] + [name for name, dtype in RECORDER_COUNTRY_COLUMNS]
+    chunk = 0
+    while os.path.exists(os.path.join(directory, CHUNK_FILE.format(chunk, names[0]))):
+        yield {name: np.load(os.path.join(directory, CHUNK_FILE.format(chunk, name)), mmap_mode=mmap_mode)
+               for name in names}
+        chunk += 1
+
+def load_trajectory(directory):
+    # whole recording in memory, columns concatenated over the weeks
+    chunks = list(iter_chunks(directory, None))
+    trajectory = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]} if chunks else {}
+    trajectory["city_ids"] = np.load(os.path.join(directory, CITY_IDS_FILE))
+    return trajectory
@@ -0,0 +1,201 @@
+# Binary scenario files: a fixed header with the country economics, budget
+# policy, infection allocation, mobility coupling, clock settings and seed,
+# then one column per city parameter (ids, positions,
+# radii, population groups, quotas, transport densities). Columns are
+# aligned little-endian arrays, so a loaded scenario is a memory map and
+# City objects are only built when asked for.
+
+import struct
+
+import numpy as np
+
+from constants import *
+from engine import Population, City, Country, SimulationClock, BUDGET_POLICIES, INFECTION_ALLOCATIONS
+from batch import BatchCountry
+from mobility import MobilityMatrix
+
+
+SCENARIO_MAGIC = b"EPIDSCN\0"
+SCENARIO_VERSION = 2
+
+# magic, version, number of cities, vaccination cost, relief cost, current funds,
+# tax per soul, start month, duration, has seed, seed, then since version 2 the
+# budget policy and infection allocation as indices into BUDGET_POLICIES and
+# INFECTION_ALLOCATIONS, has mobility, mobility cutoff and strength
+SCENARIO_HEADER = struct.Struct("<8sIq4dIIIqIIIdd")
+# headers of the versions still read, a version 1 file runs with the defaults
+SCENARIO_HEADERS = {1: struct.Struct("<8sIq4dIIIq"), 2: SCENARIO_HEADER}
+SCENARIO_PREFIX = struct.Struct("<8sI")
+SCENARIO_ALIGN = 64
+
+# name, dtype and per city shape of the columns, in file order
+SCENARIO_COLUMNS = (("city_ids", "<i8", ()),
+                    ("pos", "<f8", (2,)),
+                    ("radius", "<f8", ()),
+                    ("groups", "<i8", (Population.N_POP_CATS,)),
+                    ("vaccination_quota", "<i8", ()),
+                    ("transport_density", "<f8", ()))
+
+
+def align(offset):
+    return -(-offset // SCENARIO_ALIGN) * SCENARIO_ALIGN
+
+def get_column_offsets(n_cities, header_size=SCENARIO_HEADER.size):
+    # file offset of every column
+    offsets = {}
+    offset = align(header_size)
+    for name, dtype, shape in SCENARIO_COLUMNS:
+        offsets[name] = offset
+        offset = align(offset + n_cities * int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize)
+    return offsets
+
+
+def save_scenario(path, country, clock=None):
+    # country is a Country or a loaded Scenario
+    if clock is None:
+        clock = SimulationClock()
+    if isinstance(country, Scenario):
+        columns = country.columns
+        n_cities = country.get_n_cities()
+    else:
+        cities = country.cities
+        n_cities = len(cities)
+        columns = {"city_ids": [city.city_id for city in cities],
+                   "pos": [city.pos for city in cities],
+                   "radius": [city.r for city in cities],
+                   "groups": [city.population.population_groups for city in cities],
+                   "vaccination_quota": [city.vaccination_quota for city in cities],
+                   "transport_density": [city.transport_density for city in cities]}
+    seed = country.seed
+    # one 64 bit field, any other seed would load back as a different run
+    if seed is not None and not (isinstance(seed, (int, np.integer)) and 0 <= seed < 2 ** 63):
+        raise ValueError("seed {!r} can not be saved, scenarios take an int seed in [0, 2**63)".format(seed))
+    has_seed = seed is not None
+    mobility = country.mobility if country.mobility is not None else (0.0, 0.0)
+    header = SCENARIO_HEADER.pack(SCENARIO_MAGIC, SCENARIO_VERSION, n_cities,
+                                  country.vaccination_cost, country.relief_cost,
+                                  country.current_funds, country.tax_per_soul,
+                                  clock.start_time.month, clock.duration, has_seed, int(seed) if has_seed else 0,
+                                  BUDGET_POLICIES.index(country.budget_policy),
+                                  INFECTION_ALLOCATIONS.index(country.infection_allocation),
+                                  country.mobility is not None, *mobility)
+
+    offsets = get_column_offsets(n_cities)
+    with open(path, "wb") as f:
+        f.write(header)
+        for name, dtype, shape in SCENARIO_COLUMNS:
+            f.write(b"\0" * (offsets[name] - f.tell()))
+            f.write(np.asarray(columns[name], dtype=dtype).reshape((n_cities,) + shape).tobytes())
+
+def load_scenario(path):
+    return Scenario(path)
+
+
+class Scenario(object):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = f.read(SCENARIO_HEADER.size)
+        if len(header) < SCENARIO_PREFIX.size or header[:len(SCENARIO_MAGIC)] != SCENARIO_MAGIC:
+            raise ValueError("{} is not a scenario file".format(path))
+        magic, version = SCENARIO_PREFIX.unpack_from(header)
+        if version > SCENARIO_VERSION:
+            raise ValueError("scenario version {} is newer than supported {}".format(version, SCENARIO_VERSION))
+        header_format = SCENARIO_HEADERS.get(version)
+        if header_format is None or len(header) < header_format.size:
+            raise ValueError("{} is not a scenario file".format(path))
+        fields = header_format.unpack_from(header)
+        (magic, version, n_cities,
+         self.vaccination_cost, self.relief_cost, self.current_funds, self.tax_per_soul,
+         self.start_month, self.duration, has_seed, seed) = fields[:11]
+        self.seed = seed if has_seed else None
+
+        self.budget_policy = "sequential"
+        self.infection_allocation = Population.DEFAULT_ALLOCATION
+        self.mobility = None
+        if version >= 2:
+            policy, allocation, has_mobility, cutoff, strength = fields[11:]
+            if policy >= len(BUDGET_POLICIES) or allocation >= len(INFECTION_ALLOCATIONS):
+                raise ValueError("{} has an unknown budget policy or infection allocation".format(path))
+            self.budget_policy = BUDGET_POLICIES[policy]
+            self.infection_allocation = INFECTION_ALLOCATIONS[allocation]
+            self.mobility = (cutoff, strength) if has_mobility else None
+
+        # columns are read-only views into one map of the file
+        data = np.memmap(path, np.uint8, "r")
+        offsets = get_column_offsets(n_cities, header_format.size)
+        self.columns = {}
+        for name, dtype, shape in SCENARIO_COLUMNS:
+            size = n_cities * int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            if offsets[name] + size > len(data):
+                raise ValueError("{} is truncated".format(path))
+            column = data[offsets[name]:offsets[name] + size].view(dtype)
+            self.columns[name] = column.reshape((n_cities,) + shape)
+
+    def get_n_cities(self):
+        return len(self.columns["city_ids"])
+
+    def get_city(self, i):
+        # City of row i, not attached to a country
+        city = City()
+        groups = self.columns["groups"][i].tolist()
+        city.population.set_groups(groups)
+        city.population.total_population = sum(groups)
+        city.update_size()
+        city.update_epidemic()
+        city.r = float(self.columns["radius"][i])
+        city.pos = tuple(self.columns["pos"][i].tolist())
+        city.vaccination_quota = int(self.columns["vaccination_quota"][i])
+        city.transport_density = float(self.columns["transport_density"][i])
+        return city
+
+    def apply_clock(self, clock):
+        clock.set_start_month(self.start_month)
+        clock.set_duration(self.duration)
+
+    def to_country(self):
+        # builds every city, with the ids they were saved with
+        country = Country()
+        country.vaccination_cost = self.vaccination_cost
+        country.relief_cost = self.relief_cost
+        country.current_funds = self.current_funds
+        country.tax_per_soul = self.tax_per_soul
+        country.set_budget_policy(self.budget_policy)
+        country.set_infection_allocation(self.infection_allocation)
+        for i, city_id in enumerate(self.columns["city_ids"].tolist()):
+            country.add_city(self.get_city(i), city_id)
+        if self.mobility is not None:
+            country.set_mobility(*self.mobility)
+        if self.seed is not None:
+            country.set_seed(self.seed)
+        return country
+
+    def to_table(self):
+        # table.CityTable over the mapped columns, for looking at a map too
+        # large for City objects
+        from table import CityTable
+        return CityTable.from_columns(self.columns)
+
+    def to_batch(self, seed=None):
+        # BatchCountry straight from the columns, no City objects;
+        # seed overrides the saved one
+        groups = self.columns["groups"]
+        batch = BatchCountry(len(groups))
+        batch.city_ids[:] = self.columns["city_ids"]
+        batch.groups[:] = groups
+        batch.total[:] = groups.sum(axis=1)
+        batch.size_type[:] = np.searchsorted(CITY_SIZE_POPULATION, batch.total, side="right")
+        batch.transport_density[:] = self.columns["transport_density"]
+        batch.vaccination_quota[:] = self.columns["vaccination_quota"]
+        batch.update_epidemic()
+
+        batch.vaccination_cost = self.vaccination_cost
+        batch.relief_cost = self.relief_cost
+        batch.current_funds = self.current_funds
+        batch.tax_per_soul = self.tax_per_soul
+        # the batch engine always splits infections "capped"
+        batch.budget_policy = self.budget_policy
+        if self.mobility is not None:
+            batch.mobility = MobilityMatrix.from_positions(np.asarray(self.columns["pos"], dtype=np.float64),
+                                                           *self.mobility)
+        batch.set_seed(seed if seed is not None else self.seed)
+        return batch
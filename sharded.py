@@ -0,0 +1,227 @@
+# Sharded batch engine: the state arrays of a BatchCountry live in shared
+# memory and worker processes each step a contiguous range of cities in
+# place, so nothing is pickled per week. A week is a few barrier-separated
+# phases; the vaccine budget is split and the funds deltas are summed in the
+# main process.
+
+from math import fsum
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from engine import Population
+from batch import BatchCountry
+from mobility import MobilityMatrix
+
+
+# commands of the control block
+SHARD_STEP = 1
+SHARD_STOP = 2
+
+# control block: command, month, tax per soul, vaccination cost, relief cost
+CONTROL_SIZE = 5
+
+# seconds a barrier waits before the run is given up as broken
+SHARD_TIMEOUT = 600
+
+
+def get_shard_bounds(n_cities, n_shards):
+    # n_shards + 1 row bounds of almost equal shards
+    return [n_cities * i // n_shards for i in range(n_shards + 1)]
+
+
+class SharedArrays(object):
+    # named numpy arrays, each in its own shared memory block
+    def __init__(self):
+        self.blocks = {}
+        self.arrays = {}
+
+    def create(self, name, values):
+        values = np.ascontiguousarray(values)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        array = np.ndarray(values.shape, values.dtype, buffer=block.buf)
+        array[...] = values
+        self.blocks[name] = block
+        self.arrays[name] = array
+        return array
+
+    def get_layout(self):
+        # what a worker needs to attach to the same blocks
+        return {name: (self.blocks[name].name, array.dtype.str, array.shape) for name, array in self.arrays.items()}
+
+    @classmethod
+    def attach(cls, layout):
+        shared = cls()
+        for name, (block_name, dtype, shape) in layout.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared.blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        return shared
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        for block in self.blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # views still held elsewhere keep the mapping alive
+                pass
+            if unlink:
+                block.unlink()
+        self.blocks = {}
+
+
+def _run_shard(layout, lo, hi, shard, barrier, mobility):
+    # worker process: steps rows lo:hi of the shared state until told to stop
+    shared = SharedArrays.attach(layout)
+    arrays = shared.arrays
+    batch = control = None
+    try:
+        batch = BatchCountry(0)
+        for name in BatchCountry.STATE_ARRAYS:
+            if name in arrays:
+                setattr(batch, name, arrays[name][lo:hi])
+        control = arrays["control"]
+        while True:
+            barrier.wait(SHARD_TIMEOUT)
+            if control[0] == SHARD_STOP:
+                break
+            month = int(control[1])
+            batch.tax_per_soul, batch.vaccination_cost, batch.relief_cost = control[2:5]
+
+            if mobility is not None:
+                # infected shares of every city before anyone's week starts
+                infected = batch.get_infected_population()
+                arrays["fractions"][lo:hi] = np.divide(infected, batch.total, out=np.zeros(hi - lo),
+                                                       where=batch.total > 0)
+                barrier.wait(SHARD_TIMEOUT)
+                batch.imported_infected = mobility.apply(arrays["fractions"]) * batch.total
+
+            batch.pass_week()
+            arrays["demand"][lo:hi] = np.minimum(batch.vaccination_quota, batch.groups[:, :2].sum(axis=1))
+            barrier.wait(SHARD_TIMEOUT)
+
+            # the main process splits the budget in between
+            barrier.wait(SHARD_TIMEOUT)
+            vaccinated = batch.vaccinate(arrays["vaccines"][lo:hi])
+            batch.standard_process(month)
+            totals = batch.get_aggregates(("taxable", "relief"))
+            delta_funds = batch.tax_per_soul * totals["taxable"].astype(np.float64)
+            delta_funds -= batch.vaccination_cost * vaccinated
+            delta_funds -= batch.relief_cost * totals["relief"]
+            arrays["deltas"][shard] = delta_funds.sum()
+            batch.update_epidemic()
+            arrays["is_epidemic"][lo:hi] = batch.is_epidemic
+            barrier.wait(SHARD_TIMEOUT)
+    except Exception:
+        barrier.abort()
+        raise
+    finally:
+        # views must go before the blocks are closed
+        batch = control = arrays = None
+        shared.close()
+
+
+class ShardedCountry(BatchCountry):
+    # BatchCountry whose weeks are stepped by n_workers processes; the seed
+    # and the cities must be set before start()
+    def __init__(self, n_cities=0, seed=None):
+        self.shared = None
+        self.workers = []
+        self.barrier = None
+        BatchCountry.__init__(self, n_cities, seed)
+
+    def start(self, n_workers=None):
+        if self.workers:
+            return
+        n_workers = n_workers or multiprocessing.cpu_count()
+        n_workers = max(1, min(n_workers, self.get_n_cities()))
+        n = self.get_n_cities()
+
+        self.shared = SharedArrays()
+        for name in self.STATE_ARRAYS:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, self.shared.create(name, value))
+        self.shared.create("control", np.zeros(CONTROL_SIZE))
+        self.shared.create("fractions", np.zeros(n))
+        self.shared.create("demand", np.zeros(n, dtype=np.int64))
+        self.shared.create("vaccines", np.zeros(n, dtype=np.int64))
+        self.shared.create("deltas", np.zeros(n_workers))
+        layout = self.shared.get_layout()
+
+        self.barrier = multiprocessing.Barrier(n_workers + 1)
+        bounds = get_shard_bounds(n, n_workers)
+        for shard in range(n_workers):
+            lo, hi = bounds[shard], bounds[shard + 1]
+            mobility = None
+            if self.mobility is not None:
+                rows = (self.mobility.rows >= lo) & (self.mobility.rows < hi)
+                mobility = MobilityMatrix(hi - lo, self.mobility.rows[rows] - lo,
+                                          self.mobility.cols[rows], self.mobility.weights[rows])
+            worker = multiprocessing.Process(target=_run_shard, args=(layout, lo, hi, shard, self.barrier, mobility),
+                                             daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def close(self):
+        # stops the workers and gives the state back to private arrays
+        if not self.workers:
+            return
+        if not self.barrier.broken:
+            self.shared.arrays["control"][0] = SHARD_STOP
+            try:
+                self.barrier.wait(SHARD_TIMEOUT)
+            except Exception:
+                pass
+        for worker in self.workers:
+            worker.join(SHARD_TIMEOUT)
+        self.workers = []
+        for name in self.STATE_ARRAYS:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.copy())
+        self.shared.close(unlink=True)
+        self.shared = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        # pickles (and deep copies) as a plain BatchCountry state
+        state = dict(self.__dict__)
+        state.update(shared=None, workers=[], barrier=None)
+        return state
+
+    def set_seed(self, seed):
+        if self.workers:
+            raise ValueError("the seed of a sharded country must be set before start()")
+        BatchCountry.set_seed(self, seed)
+
+    def process_time_step(self, cur_month, infection_update_func=Population.standard_process):
+        if not self.workers:
+            return BatchCountry.process_time_step(self, cur_month, infection_update_func)
+        if infection_update_func is not Population.standard_process:
+            raise ValueError("batch engine supports only Population.standard_process")
+
+        arrays = self.shared.arrays
+        arrays["control"][:] = (SHARD_STEP, cur_month, self.tax_per_soul, self.vaccination_cost, self.relief_cost)
+        self.barrier.wait(SHARD_TIMEOUT)
+        if self.mobility is not None:
+            self.barrier.wait(SHARD_TIMEOUT)
+
+        # demands are in, split the funds of the start of the week
+        self.barrier.wait(SHARD_TIMEOUT)
+        arrays["vaccines"][:] = self.allocate_vaccines(arrays["demand"])
+        self.barrier.wait(SHARD_TIMEOUT)
+
+        self.barrier.wait(SHARD_TIMEOUT)
+        self.current_funds += fsum(arrays["deltas"].tolist())
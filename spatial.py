@@ -0,0 +1,71 @@
+# Uniform grid over city centers for hit tests and overlap checks. Cells are
+# as large as the biggest city radius, so a query only looks at the few
+# cells around the point instead of every city.
+
+from math import floor, hypot, ceil
+
+from constants import *
+
+
+class SpatialGrid(object):
+    def __init__(self, cell_size=max(CITY_SIZES), max_radius=max(CITY_SIZES)):
+        self.cell_size = float(cell_size)
+        # no city radius is larger, queries widen by it
+        self.max_radius = max_radius
+        self.cells = {}
+
+    def get_cell(self, pos):
+        return (int(floor(pos[0] / self.cell_size)), int(floor(pos[1] / self.cell_size)))
+
+    def insert(self, city):
+        self.cells.setdefault(self.get_cell(city.pos), []).append(city)
+
+    def remove(self, city, pos=None):
+        # pos is where the city was inserted, if it has moved since
+        cell = self.get_cell(city.pos if pos is None else pos)
+        bucket = self.cells[cell]
+        bucket.remove(city)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, city, old_pos):
+        if self.get_cell(old_pos) != self.get_cell(city.pos):
+            self.remove(city, old_pos)
+            self.insert(city)
+
+    def clear(self):
+        self.cells = {}
+
+    def query(self, pos, radius):
+        # cities whose center is closer than radius + city radius to pos
+        x, y = pos
+        reach = int(ceil((radius + self.max_radius) / self.cell_size))
+        cx, cy = self.get_cell(pos)
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for city in self.cells.get((i, j), ()):
+                    if hypot(city.pos[0] - x, city.pos[1] - y) < radius + city.r:
+                        yield city
+
+    def query_rect(self, x0, y0, x1, y1):
+        # cities whose bounding square overlaps the rectangle
+        reach = self.max_radius
+        i0, j0 = self.get_cell((x0 - reach, y0 - reach))
+        i1, j1 = self.get_cell((x1 + reach, y1 + reach))
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            # a wide rectangle, the filled cells are fewer
+            buckets = [bucket for (i, j), bucket in self.cells.items() if i0 <= i <= i1 and j0 <= j <= j1]
+        else:
+            buckets = [self.cells.get((i, j), ()) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+        for bucket in buckets:
+            for city in bucket:
+                x, y = city.pos
+                r = city.r
+                if x + r > x0 and x - r < x1 and y + r > y0 and y - r < y1:
+                    yield city
+
+    def find(self, pos):
+        return next(self.query(pos, 0), None)
+
+    def is_free(self, pos, r):
+        return next(self.query(pos, r), None) is None
@@ -0,0 +1,111 @@
+# Parameter sweeps: a grid or latin hypercube over country economics and city
+# parameters, evaluated in parallel on the batch engine and written to a
+# columnar .npz file (one array per parameter and per outcome).
+
+from copy import deepcopy
+from functools import partial
+from itertools import product
+import re
+
+import numpy as np
+
+from engine import SimulationClock, Simulation
+from batch import BatchCountry
+from pool import scenario_pool, run_task
+
+
+SWEEP_COUNTRY_PARAMS = ("tax_per_soul", "vaccination_cost", "relief_cost", "current_funds")
+# city parameters apply to every city, or to the city with id i as "name[i]"
+SWEEP_CITY_PARAMS = ("vaccination_quota", "transport_density")
+
+SWEEP_OUTCOMES = ("final_funds", "min_funds", "broke", "broke_week",
+                  "peak_infected", "infected_weeks", "final_immune")
+
+CITY_PARAM_RE = re.compile(r"^(\w+)\[(\d+)\]$")
+
+
+def grid(**axes):
+    # every combination of the given values, as a list of points
+    names = list(axes)
+    return [dict(zip(names, values)) for values in product(*(axes[name] for name in names))]
+
+def latin_hypercube(n, seed=None, **ranges):
+    # n points, each (low, high) range cut into n strata used once per axis
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name, (low, high) in ranges.items():
+        strata = (rng.permutation(n) + rng.random(n)) / n
+        columns[name] = low + strata * (high - low)
+    return [{name: float(columns[name][i]) for name in ranges} for i in range(n)]
+
+
+def apply_point(batch, point):
+    for name, value in point.items():
+        match = CITY_PARAM_RE.match(name)
+        if name in SWEEP_COUNTRY_PARAMS:
+            setattr(batch, name, float(value))
+        elif name in SWEEP_CITY_PARAMS:
+            getattr(batch, name)[:] = value
+        elif match and match.group(1) in SWEEP_CITY_PARAMS:
+            # rows are not ids once a city was removed
+            rows = np.flatnonzero(batch.city_ids == int(match.group(2)))
+            if len(rows) == 0:
+                raise ValueError("no city with id {} for sweep parameter {}".format(match.group(2), name))
+            getattr(batch, match.group(1))[rows[0]] = value
+        else:
+            raise ValueError("unknown sweep parameter: {}".format(name))
+
+def evaluate_point(base, clock, point, seed):
+    # all points of a sweep share the seed, so they see the same random numbers
+    batch = deepcopy(base)
+    batch.set_seed(seed)
+    apply_point(batch, point)
+    simulation = Simulation(batch)
+    simulation.clock = deepcopy(clock)
+
+    outcome = dict.fromkeys(SWEEP_OUTCOMES, 0)
+    outcome["min_funds"] = batch.current_funds
+    outcome["broke"] = False
+    outcome["broke_week"] = -1
+    week = 0
+    while not simulation.finished:
+        result = simulation.step()
+        infected = batch.get_total_infected()
+        outcome["min_funds"] = min(outcome["min_funds"], batch.current_funds)
+        outcome["peak_infected"] = max(outcome["peak_infected"], infected)
+        outcome["infected_weeks"] += infected
+        if result == Simulation.FLAT_BROKE:
+            outcome["broke"] = True
+            outcome["broke_week"] = week
+        week += 1
+    outcome["final_funds"] = batch.current_funds
+    outcome["final_immune"] = batch.get_total_immune()
+    return outcome
+
+
+def _evaluate_worker_point(scenario, point):
+    base, clock, seed = scenario
+    return evaluate_point(base, clock, point, seed)
+
+
+def run_sweep(country, points, path=None, clock=None, seed=0, max_workers=None, chunksize=4):
+    # evaluate every point in parallel, returns the columns and saves them
+    # to path (.npz) when given
+    if clock is None:
+        clock = SimulationClock()
+    base = BatchCountry.from_country(country)
+    with scenario_pool((base, clock, seed), max_workers) as pool:
+        outcomes = list(pool.map(partial(run_task, _evaluate_worker_point), points, chunksize=chunksize))
+
+    columns = {}
+    for name in sorted({name for point in points for name in point}):
+        columns[name] = np.array([point.get(name, np.nan) for point in points], dtype=np.float64)
+    for name in SWEEP_OUTCOMES:
+        columns[name] = np.array([outcome[name] for outcome in outcomes])
+    if path is not None:
+        np.savez(path, **columns)
+    return columns
+
+def load_sweep(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
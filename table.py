@@ -0,0 +1,228 @@
+# Struct-of-arrays city storage: one numpy column per city parameter instead
+# of a City and a Population object per city, about 300 bytes a city with
+# the 32 groups against about 1.1 KB for a City. Rows are read through
+# CityRow views that have the attributes and getters of City, so code that
+# draws or inspects cities takes either. A table is not stepped itself: a
+# map of a million cities is simulated as a batch.BatchCountry, which holds
+# the same state columns, and looked at through CityTable.from_batch.
+
+import numpy as np
+
+from constants import *
+from engine import Population
+from batch import AGGREGATE_MATRIX, AGGREGATE_COLUMN
+
+
+# name, dtype and per city shape of the columns
+CITY_TABLE_COLUMNS = (("city_ids", np.int64, ()),
+                      ("pos", np.float64, (2,)),
+                      ("r", np.float64, ()),
+                      ("groups", np.int64, (Population.N_POP_CATS,)),
+                      ("vaccination_quota", np.int64, ()),
+                      ("transport_density", np.float64, ()),
+                      ("is_epidemic", np.bool_, ()),
+                      ("alpha", np.uint8, ()))
+
+# aggregates the rows are asked for, columns of CityTable.aggregates
+TABLE_AGGREGATES = ("infected", "vaccinated", "immune")
+TABLE_AGGREGATE_COLUMN = {name: k for k, name in enumerate(TABLE_AGGREGATES)}
+
+# (normal, infected, epidemic) colors of every city not listed in CityTable.colors
+DEFAULT_CITY_COLORS = (CITY_NORMAL_COLOR, CITY_INFECTED_COLOR, CITY_EPIDEMIC_COLOR)
+
+
+class CityRow(object):
+    # one city of a table, made on access and holding nothing but the row
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def city_id(self):
+        return int(self.table.city_ids[self.row])
+
+    @property
+    def pos(self):
+        return tuple(self.table.pos[self.row].tolist())
+
+    @property
+    def r(self):
+        return float(self.table.r[self.row])
+
+    @property
+    def is_epidemic(self):
+        return bool(self.table.is_epidemic[self.row])
+
+    @property
+    def alpha(self):
+        return int(self.table.alpha[self.row])
+
+    @property
+    def vaccination_quota(self):
+        return int(self.table.vaccination_quota[self.row])
+
+    @property
+    def transport_density(self):
+        return float(self.table.transport_density[self.row])
+
+    @property
+    def norm_color(self):
+        return self.table.get_colors(self.row)[0]
+
+    @property
+    def infect_color(self):
+        return self.table.get_colors(self.row)[1]
+
+    @property
+    def epid_color(self):
+        return self.table.get_colors(self.row)[2]
+
+    # same getters as City
+    def get_radius(self):
+        return self.r
+
+    def get_infected_radius(self):
+        population = self.get_population()
+        return self.r * ((self.get_infected() / population) ** 0.7) if population else 0
+
+    def get_population(self):
+        return int(self.table.total[self.row])
+
+    def get_infected(self):
+        return self.table.get_aggregate(self.row, "infected")
+
+    def get_vaccinated(self):
+        return self.table.get_aggregate(self.row, "vaccinated")
+
+    def get_immune(self):
+        return self.table.get_aggregate(self.row, "immune")
+
+
+class CityRows(object):
+    # sequence of the rows of a table, like Country.cities
+    __slots__ = ("table",)
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.get_n_cities()
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("city row out of range")
+        return CityRow(self.table, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield CityRow(self.table, row)
+
+
+class CityTable(object):
+    def __init__(self, n_cities=0):
+        for name, dtype, shape in CITY_TABLE_COLUMNS:
+            setattr(self, name, np.zeros((n_cities,) + shape, dtype=dtype))
+        self.alpha[:] = CITY_ALPHA
+        # row: colors, only for cities whose colors differ from the defaults
+        self.colors = {}
+        # city id: row, made on the first lookup
+        self.id_rows = None
+        self.update_aggregates()
+
+    @classmethod
+    def from_country(cls, country):
+        cities = country.cities
+        n = len(cities)
+        table = cls(0)
+        table.city_ids = np.fromiter((city.city_id for city in cities), np.int64, n)
+        table.pos = np.array([city.pos for city in cities], dtype=np.float64).reshape(n, 2)
+        table.r = np.fromiter((city.r for city in cities), np.float64, n)
+        table.groups = np.array([city.population.population_groups for city in cities],
+                                dtype=np.int64).reshape(n, Population.N_POP_CATS)
+        table.vaccination_quota = np.fromiter((city.vaccination_quota for city in cities), np.int64, n)
+        table.transport_density = np.fromiter((city.transport_density for city in cities), np.float64, n)
+        table.is_epidemic = np.fromiter((city.is_epidemic for city in cities), np.bool_, n)
+        table.alpha = np.fromiter((city.alpha for city in cities), np.uint8, n)
+        for row, city in enumerate(cities):
+            colors = (city.norm_color, city.infect_color, city.epid_color)
+            if colors != DEFAULT_CITY_COLORS:
+                table.colors[row] = colors
+        table.update_aggregates()
+        return table
+
+    @classmethod
+    def from_columns(cls, columns):
+        # from scenario columns, the arrays are used as they are
+        table = cls(0)
+        table.city_ids = columns["city_ids"]
+        table.pos = columns["pos"]
+        table.r = columns["radius"]
+        table.groups = columns["groups"]
+        table.vaccination_quota = columns["vaccination_quota"]
+        table.transport_density = columns["transport_density"]
+        table.alpha = np.full(len(table.city_ids), CITY_ALPHA, dtype=np.uint8)
+        table.update_aggregates()
+        infected = table.aggregates[:, TABLE_AGGREGATE_COLUMN["infected"]]
+        table.is_epidemic = infected >= table.total * EPIDEMIC_BORDER
+        return table
+
+    @classmethod
+    def from_batch(cls, batch, pos, r):
+        # the current state of a BatchCountry with the given places; the
+        # state columns are shared, so take a new table after each step
+        table = cls(0)
+        table.city_ids = batch.city_ids
+        table.pos = pos
+        table.r = r
+        table.groups = batch.groups
+        table.vaccination_quota = batch.vaccination_quota
+        table.transport_density = batch.transport_density
+        table.is_epidemic = batch.is_epidemic
+        table.alpha = np.full(len(table.city_ids), CITY_ALPHA, dtype=np.uint8)
+        table.update_aggregates()
+        return table
+
+    def update_aggregates(self):
+        # totals and aggregates of every row, after the groups changed
+        columns = [AGGREGATE_COLUMN[name] for name in TABLE_AGGREGATES]
+        self.total = self.groups.sum(axis=1)
+        self.aggregates = self.groups @ AGGREGATE_MATRIX[:, columns]
+
+    def get_aggregate(self, row, name):
+        return int(self.aggregates[row, TABLE_AGGREGATE_COLUMN[name]])
+
+    def get_infected_radii(self):
+        # CityRow.get_infected_radius of every row
+        infected = self.aggregates[:, TABLE_AGGREGATE_COLUMN["infected"]]
+        share = np.divide(infected, self.total, out=np.zeros(len(self.total)), where=self.total > 0)
+        return self.r * share ** 0.7
+
+    def get_n_cities(self):
+        return len(self.city_ids)
+
+    @property
+    def cities(self):
+        return CityRows(self)
+
+    def get_colors(self, row):
+        return self.colors.get(row, DEFAULT_CITY_COLORS)
+
+    def get_row(self, city_id):
+        # row of a city id, None if there is no such city
+        if self.id_rows is None:
+            self.id_rows = {city_id: row for row, city_id in enumerate(self.city_ids.tolist())}
+        return self.id_rows.get(city_id)
+
+    def get_city(self, city_id):
+        row = self.get_row(city_id)
+        return CityRow(self, row) if row is not None else None
+
+    def get_totals(self):
+        # same keys as Country.get_totals
+        population = int(self.total.sum())
+        infected, vaccinated, immune = self.aggregates.sum(axis=0).tolist()
+        return {"population": population, "infected": infected, "vaccinated": vaccinated, "immune": immune}
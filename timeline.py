@@ -0,0 +1,120 @@
+# Checkpoints of a running simulation for going back to an earlier week: a
+# full snapshot every few weeks and the changed cities of each week in
+# between. A recorded week is rebuilt from the keyframe before it and the
+# deltas after that keyframe, weeks whose deltas were dropped under the memory
+# cap (or that have none, like BatchCountry runs) are replayed from the
+# keyframe. Replayed weeks match the recorded ones only for seeded countries.
+
+
+def get_snapshot_size(snapshot):
+    # bytes held by a Country or BatchCountry snapshot
+    if isinstance(snapshot, dict):
+        return sum(value.nbytes for value in snapshot.values() if hasattr(value, "nbytes"))
+    return snapshot.get_size()
+
+
+class Timeline(object):
+    def __init__(self, interval=4, max_bytes=256 << 20):
+        # keyframe every interval weeks, deltas and keyframes together
+        # are kept under max_bytes
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.replaying = False
+        self.clear()
+
+    def clear(self):
+        # week -> Simulation.snapshot()
+        self.keyframes = {}
+        # week -> (country delta from the week before, clock time, preparing, finished)
+        self.deltas = {}
+        self.size = 0
+        self.last_week = -1
+        # (week, Simulation.snapshot()) the simulation is at, deltas are taken from it
+        self.current = None
+
+    def get_last_week(self):
+        return self.last_week
+
+    def get_weeks(self):
+        return range(self.last_week + 1)
+
+    def record(self, simulation):
+        # called by Simulation after every step
+        if self.replaying:
+            return
+        week = simulation.clock.get_week()
+        # stepping on after going back starts a new branch
+        self.truncate(week - 1)
+
+        previous = self.current
+        if week % self.interval == 0 or previous is None or previous[0] != week - 1:
+            snapshot = simulation.snapshot()
+            self.keyframes[week] = snapshot
+            self.size += get_snapshot_size(snapshot[0])
+            self.current = (week, snapshot)
+        elif previous[1] is not None and hasattr(previous[1][0], "diff"):
+            snapshot = simulation.snapshot()
+            self.deltas[week] = (snapshot[0].diff(previous[1][0]),) + snapshot[1:]
+            self.size += self.deltas[week][0].get_size()
+            self.current = (week, snapshot)
+        else:
+            # no deltas for this kind of snapshot, the week is replayed
+            self.current = (week, None)
+        self.last_week = week
+        self.evict()
+
+    def truncate(self, week):
+        # forget everything recorded after week
+        for later in [w for w in self.keyframes if w > week]:
+            self.size -= get_snapshot_size(self.keyframes.pop(later)[0])
+        for later in [w for w in self.deltas if w > week]:
+            self.size -= self.deltas.pop(later)[0].get_size()
+        self.last_week = min(self.last_week, week)
+
+    def evict(self):
+        # deltas go first, from the end of the oldest segment so the rest of it
+        # can still be patched; then keyframes, except the first and the last
+        while self.size > self.max_bytes:
+            if self.deltas:
+                oldest = min(self.deltas)
+                segment_end = min([w for w in self.keyframes if w > oldest], default=self.last_week + 1)
+                victim = max(w for w in self.deltas if w < segment_end)
+                self.size -= self.deltas.pop(victim)[0].get_size()
+            elif len(self.keyframes) > 2:
+                victim = sorted(self.keyframes)[1]
+                self.size -= get_snapshot_size(self.keyframes.pop(victim)[0])
+            else:
+                break
+
+    def seek(self, simulation, week):
+        # put simulation back to a recorded week
+        if week not in self.get_weeks():
+            raise ValueError("week {} is not recorded".format(week))
+        if self.current is not None and self.current[0] == week and self.current[1] is not None:
+            simulation.restore(self.current[1])
+            return
+
+        start = max(w for w in self.keyframes if w <= week)
+        snapshot = self.keyframes[start]
+        reached = start
+        while reached < week and reached + 1 in self.deltas:
+            reached += 1
+            delta, time, preparing, finished = self.deltas[reached]
+            snapshot = (snapshot[0].patch(delta), time, preparing, finished)
+        simulation.restore(snapshot)
+
+        if reached < week:
+            self.replaying = True
+            try:
+                while reached < week:
+                    simulation.step()
+                    reached += 1
+            finally:
+                self.replaying = False
+            snapshot = simulation.snapshot()
+        self.current = (week, snapshot)
+
+    def branch(self, simulation, week):
+        # go back to week and drop the weeks after it, the run continues from there
+        self.seek(simulation, week)
+        self.truncate(week)
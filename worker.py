@@ -0,0 +1,180 @@
+# Simulation stepping off the GUI thread. The worker lives on its own
+# QThread and owns the engine while a simulation runs: the widget calls
+# into it with a blocking queued signal and gets back immutable frames to
+# draw. While a frame waits to be drawn the timer ticks are dropped, so a
+# slow window slows the run down instead of queueing weeks.
+
+from time import perf_counter
+
+from PySide2 import QtCore
+
+from constants import *
+from table import CityTable
+
+
+class Frame(object):
+    # state of the simulation after a step, with the getters of Country
+    def __init__(self, simulation, state=None):
+        country = simulation.country
+        # the cities as table rows, no objects per city
+        self.table = CityTable.from_country(country)
+        self.cities = self.table.cities
+
+        self.current_funds = country.current_funds
+        self.tax_per_soul = country.tax_per_soul
+        self.vaccination_cost = country.vaccination_cost
+        self.relief_cost = country.relief_cost
+        # counted by the engine once per step
+        totals = country.get_totals()
+        self.total_population = totals["population"]
+        self.total_infected = totals["infected"]
+        self.total_vaccinated = totals["vaccinated"]
+        self.total_immune = totals["immune"]
+
+        self.time = simulation.clock.time
+        self.duration = simulation.clock.duration
+        self.week = simulation.clock.get_week()
+        self.last_week = simulation.timeline.get_last_week() if simulation.timeline is not None else self.week
+        self.preparing = simulation.preparing
+        self.finished = simulation.finished
+        # finish state of the step, None while running
+        self.state = state
+
+    def get_city(self, city_id):
+        return self.table.get_city(city_id)
+
+    def get_current_funds(self):
+        return self.current_funds
+
+    def get_tax(self):
+        return self.tax_per_soul
+
+    def get_vaccination_cost(self):
+        return self.vaccination_cost
+
+    def get_relief_cost(self):
+        return self.relief_cost
+
+    def get_total_population(self):
+        return self.total_population
+
+    def get_total_infected(self):
+        return self.total_infected
+
+    def get_total_vaccinated(self):
+        return self.total_vaccinated
+
+    def get_total_immune(self):
+        return self.total_immune
+
+
+class SimulationWorker(QtCore.QObject):
+    FrameReady = QtCore.Signal(object)
+
+    def __init__(self, simulation):
+        QtCore.QObject.__init__(self)
+        self.simulation = simulation
+
+        # a child, so it moves to the worker thread with the worker
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.tick)
+        # fast-forward steps in batches of one frame time, going back to the
+        # event loop in between so calls from the widget get through
+        self.fast_forward_timer = QtCore.QTimer(self)
+        self.fast_forward_timer.setInterval(0)
+        self.fast_forward_timer.timeout.connect(self.fast_forward_batch)
+
+        # set while a published frame is not drawn yet
+        self.frame_pending = False
+        self.dropped_ticks = 0
+
+        self.result = None
+        self.error = None
+
+    @QtCore.Slot(object)
+    def call(self, func):
+        # runs func on the worker thread, the caller waits and takes the result
+        try:
+            self.result = func()
+        except Exception as error:
+            self.error = error
+
+    def take_result(self):
+        result, error = self.result, self.error
+        self.result = self.error = None
+        if error is not None:
+            raise error
+        return result
+
+    def start(self):
+        if not self.simulation.finished:
+            self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.fast_forward_timer.stop()
+
+    def fast_forward(self):
+        # run to the end without waiting for the timer
+        self.timer.stop()
+        if not self.simulation.finished:
+            self.fast_forward_timer.start()
+
+    def set_interval(self, interval):
+        self.timer.setInterval(int(interval))
+
+    def init_simulation(self):
+        self.simulation.init_simulation()
+        self.publish()
+
+    # a declared slot, an undeclared one turns the worker's connections
+    # into ones handled on the GUI thread
+    @QtCore.Slot()
+    def tick(self):
+        if self.frame_pending:
+            self.dropped_ticks += 1
+            return
+        self.step()
+
+    @QtCore.Slot()
+    def fast_forward_batch(self):
+        end = perf_counter() + 1.0 / FAST_FORWARD_FPS
+        state = None
+        while state is None and perf_counter() < end:
+            state = self.simulation.step()
+        if state is not None:
+            self.fast_forward_timer.stop()
+            self.publish(state)
+        elif not self.frame_pending:
+            self.publish()
+
+    def step(self):
+        state = self.simulation.step()
+        if state is not None:
+            self.timer.stop()
+        self.publish(state)
+
+    def edit(self, func):
+        # engine change made by the widget, shown at once while running
+        result = func()
+        if not self.simulation.preparing:
+            self.publish()
+        return result
+
+    def seek(self, week):
+        self.stop()
+        self.simulation.timeline.seek(self.simulation, week)
+        self.publish()
+
+    def reset(self):
+        self.stop()
+        self.simulation.reset()
+
+    def publish(self, state=None):
+        self.frame_pending = True
+        self.FrameReady.emit(Frame(self.simulation, state))
+
+    def frame_done(self):
+        # called by the widget once the frame is drawn
+        self.frame_pending = False